@@ -38,7 +38,7 @@ setup(
     modules_dir  = { "": "Sources" },
     packages     = ["easyhg","urwid"],
     py_modules      = ["urwide"],
-    scripts      = ["bin/easymerge"]
+    scripts      = ["bin/easymerge", "bin/easyhg-daemon", "bin/easycommit-batch"]
 )
 
 # EOF - vim: tw=80 ts=4 sw=4 noet
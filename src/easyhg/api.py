@@ -10,7 +10,8 @@
 # Last mod  : 05-Oct-2007
 # -----------------------------------------------------------------------------
 
-import os, string, time, datetime, re, base64, pickle, types, sha, popen2
+import os, string, time, datetime, re, base64, pickle, types, sha, popen2, socket, struct
+import subprocess, multiprocessing, zlib, collections
 import mercurial.ui, mercurial.hg, mercurial.localrepo, mercurial.sshrepo, mercurial.scmutil
 
 # TODO: Completely remove dependency on Mercurial
@@ -216,54 +217,71 @@ class Repository:
 			path     = os.path.dirname(path)
 		return None
 
-	def __init__(self, path=None, repo=None, ui=None):
+	def __init__(self, path=None, repo=None, ui=None, daemon=True):
 		"""Creates a new Repository wrapper for a repository at the given path,
 		or for the given repository instance. If a Mercurial UI is given, it
-		will be used, otherwise it will be created."""
-		self._path       = path
-		self.api         = None
-		self._loadedFrom = None
-		self._init(path,repo,ui)
+		will be used, otherwise it will be created. When @daemon is True (the
+		default) and an `easyhg.daemon` is serving the repository, the API calls
+		are forwarded to it instead of being run directly.
 
-	def _init( self, path=None, repo=None, ui=None ):
+		The Mercurial UI and repository, the API and the configuration are
+		only created when first needed (see '__getattr__'), so that creating
+		a repository is nearly free."""
 		# We extract the HG repository if necessary
 		if repo and isinstance(repo, Repository):
 			repo = repo.hgrepo()
-		# We remove the .hg from the path, if present
-		# We initialize the UI first
-		if ui:
-			self._ui = ui
+		if ui:   self._ui   = ui
+		if repo: self._repo = repo
+		self._path       = path
+		self._daemon     = daemon
+		self._loadedFrom = None
+
+	def __getattr__( self, name ):
+		# This is only invoked for missing attributes, so that the lazily
+		# created attributes are accessed directly once created.
+		if   name == "_ui":    self._ui   = self._createUI()
+		elif name == "_repo":  self._repo = self._openRepository()
+		elif name == "api":    self._bindAPI()
+		elif name == "config": self.config = self._loadConfiguration()
+		else: raise AttributeError(name)
+		return self.__dict__[name]
+
+	def _createUI( self ):
 		# We have to use this trick to make sure the UI configuration is loaded
 		# from the repository path, and not from the current location
+		oldrc_path = mercurial.scmutil.rcpath()
+		p = self._path or self._repo.path
+		if p.endswith("hgrc"): pass
+		elif p.endswith(".hg"): p = os.path.join(p, "hgrc")
+		else: p = os.path.join(p, ".hg", "hgrc")
+		mercurial.ui.util._rcpath = p
+		ui = mercurial.ui.ui()
+		ui.quiet = True
+		mercurial.ui.util._rcpath = oldrc_path
+		return ui
+
+	def _openRepository( self ):
+		# We remove the .hg from the path, if present
+		path = self._path
+		if path.endswith(".hg"): path = os.path.dirname(path)
+		return mercurial.hg.repository(self._ui, path)
+
+	def _bindAPI( self ):
+		if self.isSSH():
+			api = MercurialSSH(self)
+		elif self.isLocal():
+			api = self._daemon and MercurialDaemon.connect(self, self.path())
+			api = api or MercurialLocal(self)
 		else:
-			oldrc_path = mercurial.scmutil.rcpath()
-			p = path or repo.path
-			if p.endswith("hgrc"): pass
-			elif p.endswith(".hg"): p = os.path.join(p, "hgrc")
-			else: p = os.path.join(p, ".hg", "hgrc")
-			mercurial.ui.util._rcpath = p
-			self._ui   = mercurial.ui.ui()
-			self._ui.quiet = True
-			mercurial.ui.util._rcpath = oldrc_path
-		# And then the repository
-		if repo:
-			self._repo = repo
-		else:
-			if path.endswith(".hg"): path = os.path.dirname(path)
-			self._repo = mercurial.hg.repository(self._ui, path)
-		if not self.api:
-			if self.isSSH():
-				self.api = api = MercurialSSH(self)
-			elif self.isLocal():
-				self.api = api = MercurialLocal(self)
-			else:
-				raise self.RepositoryNotSupported(self._repo.__class__.__name__)
-		self.api.bind(self)
-		# And the configuration
+			raise self.RepositoryNotSupported(self._repo.__class__.__name__)
+		self.api = api
+		api.bind(self)
+
+	def _loadConfiguration( self ):
 		try:
-			self.config   = Configuration(self)
+			return Configuration(self)
 		except Configuration.NotFound:
-			self.config   = Configuration()
+			return Configuration()
 
 	def isLocal( self ):
 		"""Tells if this repository is a local repository"""
@@ -308,17 +326,23 @@ class Repository:
 
 	def __getstate__( self ):
 		odict = self.__dict__.copy() # copy the dict since we change it
-		del odict['_repo']
-		del odict['_ui']
+		odict.pop('_repo', None)
+		odict.pop('_ui', None)
 		for name in odict.keys():
 			if type(odict[name]) == types.MethodType:
 				del odict[name]
+		# A daemon connection cannot be restored, it is renegotiated instead
+		if isinstance(odict.get("api"), MercurialDaemon):
+			del odict["api"]
 		return odict
 
 	def __setstate__( self, data ):
 		self.__dict__.update(data)
-		self.api._repo = self
-		self._init(path=self._path)
+		self.__dict__.setdefault("_daemon", True)
+		api = self.__dict__.get("api")
+		if api:
+			api._repo = self
+			api.bind(self)
 
 	# ACCESSORS
 	# _________________________________________________________________________
@@ -334,7 +358,11 @@ class Repository:
 
 	def path(self):
 		"""Returns the path to the repository, without the trailing .hg"""
-		path = self._repo.path
+		# Local paths do not require the repository to be opened
+		if self._path and "://" not in self._path:
+			path = os.path.realpath(os.path.expanduser(self._path))
+		else:
+			path = self._repo.path
 		if path.endswith("/"):    path = path[:-1]
 		if path.endswith(".hg"):  path = path[:-3]
 		if path.endswith("/"):    path = path[:-1]
@@ -374,6 +402,44 @@ class Repository:
 		"""Sets a property in this project configuration"""
 		return map(string.strip, str(self._property(name)).split())
 
+	# API
+	# _________________________________________________________________________
+	# These methods bind the API on first use, which then replaces them with
+	# its own methods (see 'MercurialAPI.bind').
+
+	def count( self ):
+		return self.api.count()
+
+	def changes( self, n=None, full=False ):
+		return self.api.changes(n, full)
+
+	def fileCat( self, path, revision="tip" ):
+		return self.api.fileCat(path, revision)
+
+	def fileSig( self, path, revision="tip" ):
+		return self.api.fileSig(path, revision)
+
+	def tip( self ):
+		return self.api.tip()
+
+	def tags( self ):
+		return self.api.tags()
+
+	def modifications( self ):
+		return self.api.modifications()
+
+	def diffstats( self, revisions="0:tip", workers=None ):
+		return self.api.diffstats(revisions, workers)
+
+	def churn( self, revisions="0:tip", workers=None ):
+		return self.api.churn(revisions, workers)
+
+	def readConfiguration( self ):
+		return self.api.readConfiguration()
+
+	def writeConfiguration( self, text ):
+		return self.api.writeConfiguration(text)
+
 # ------------------------------------------------------------------------------
 #
 # CHANGESET
@@ -393,9 +459,14 @@ class ChangeSet:
 	  -  @files
 	  -  @description
 
+	When the changeset is created with a @loader (a 'MercurialAPI'), the
+	@files and @description are only fetched when first accessed, together
+	with the ones of the neighbouring changesets (see 'MercurialAPI.loadDetails').
 	"""
 
-	def __init__( self ):
+	DETAILS = ("files", "description")
+
+	def __init__( self, loader=None ):
 		self.num         = -1
 		self.id          = None
 		self.tag         = None
@@ -403,10 +474,35 @@ class ChangeSet:
 		self.datetime    = None
 		self.zone        = None
 		self.user        = None
-		self.files       = []
 		self.reponame    = None
-		self.description = ""
 		self.summary     = ""
+		self._loader     = loader
+		if not loader:
+			self.files       = []
+			self.description = ""
+
+	def __getattr__( self, name ):
+		# This is only invoked for missing attributes, so that loaded details
+		# are accessed directly.
+		loader = self.__dict__.get("_loader")
+		if name in ChangeSet.DETAILS and loader:
+			loader.loadDetails(self)
+			return self.__dict__[name]
+		raise AttributeError(name)
+
+	def hasDetails( self ):
+		"""Tells if the files and description were already loaded."""
+		return "description" in self.__dict__
+
+	def setDetails( self, files, description ):
+		self.files       = files
+		self.description = description
+		self._loader     = None
+
+	def __getstate__( self ):
+		odict = self.__dict__.copy()
+		odict["_loader"] = None
+		return odict
 
 	def abstime( self ):
 		# And apply the timezone information
@@ -440,6 +536,10 @@ description:
 """ % (self.num, self.id, self.user, time.strftime("%a %b %d %H:%M:%S %Y",self.time), self.zone, " ".join(self.files),
 self.description)
 
+DETAILS_BATCH    = 100
+DETAILS_MARKER   = "@@EASYHG_CHANGESET@@ "
+DETAILS_TEMPLATE = DETAILS_MARKER + "{rev}\\n{files}\\n{desc}\\n"
+
 # ------------------------------------------------------------------------------
 #
 # MODIFICATION
@@ -481,6 +581,74 @@ class Tag:
 	def __str__( self ):
 		return "%-31s%5d:%s" % (self.name, self.num, self.id)
 
+# ------------------------------------------------------------------------------
+#
+# DIFFSTAT
+#
+# ------------------------------------------------------------------------------
+
+DIFFSTAT_CACHE  = "easyhg-diffstat"
+DIFFSTAT_CHUNK  = 50
+DIFFSTAT_MARKER = "changeset: "
+RE_HUNK         = re.compile("^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@")
+
+def parse_diffstat( lines, marker=DIFFSTAT_MARKER ):
+	"""Parses the lines of a unified diff (as output by 'hg diff' or by 'hg log
+	-p', preferably with '--git') and returns a list of '(NODE, STATS)' couples,
+	where STATS maps each path to an '(ADDED, REMOVED)' couple of line counts.
+	Each NODE is given by a line starting with the @marker that precedes the
+	changeset diff, and is None when the diff has no marker."""
+	result = []
+	stats  = None
+	counts = None
+	old    = new = 0
+	for line in lines:
+		# Within a hunk, the line counts from the header tell where it ends
+		if old > 0 or new > 0:
+			c = line[:1]
+			if   c == "+":
+				counts[0] += 1 ; new -= 1
+			elif c == "-":
+				counts[1] += 1 ; old -= 1
+			elif c != "\\":
+				old -= 1 ; new -= 1
+		elif line.startswith(marker):
+			stats  = {}
+			counts = None
+			result.append((line[len(marker):].strip(), stats))
+		elif line.startswith("diff "):
+			if stats is None:
+				stats = {}
+				result.append((None, stats))
+			counts = stats.setdefault(_diff_path(line), [0, 0])
+		elif line.startswith("@@") and counts is not None:
+			match = RE_HUNK.match(line)
+			if match:
+				old = match.group(1) is None and 1 or int(match.group(1))
+				new = match.group(2) is None and 1 or int(match.group(2))
+	return [(node, dict((p, tuple(c)) for p, c in stats.items())) for node, stats in result]
+
+def _diff_path( line ):
+	"""Returns the (new) path of the file from a 'diff' header line, which is
+	either 'diff --git a/PATH b/PATH' or 'diff -r REV [-r REV] PATH'."""
+	if line.startswith("diff --git "):
+		return line.rsplit(" b/", 1)[-1]
+	words = line.split(" ")[1:]
+	while len(words) > 2 and words[0] == "-r":
+		words = words[2:]
+	return " ".join(words)
+
+def _diffstat_worker( args ):
+	"""Computes the diffstats of the given changeset nodes in a single 'hg log'
+	invocation. This is the unit of work of the 'MercurialLocal.diffstats'
+	process pool."""
+	hg, root, nodes = args
+	command = [hg, "--repository", root, "log", "--git", "-p",
+	"--template", DIFFSTAT_MARKER + "{node}\\n"]
+	for node in nodes: command.extend(("-r", node))
+	output  = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0]
+	return parse_diffstat(output.split("\n"))
+
 # ------------------------------------------------------------------------------
 #
 # MERCURIAL API
@@ -497,6 +665,12 @@ class MercurialAPI:
 
 	def __init__( self, repo ):
 		self._repo = repo
+		self._lazy = {}
+
+	def __setstate__( self, data ):
+		self.__dict__.update(data)
+		self.__dict__.setdefault("_lazy", {})
+		for changeset in self._lazy.values(): changeset._loader = self
 
 	def bind( self, repo ):
 		assert isinstance(repo, Repository)
@@ -507,6 +681,8 @@ class MercurialAPI:
 		repo.tip     = self.tip
 		repo.tags    = self.tags
 		repo.modifications = self.modifications
+		repo.diffstats = self.diffstats
+		repo.churn   = self.churn
 		repo.writeConfiguration = self.writeConfiguration
 		repo.readConfiguration = self.readConfiguration
 		self._start()
@@ -519,11 +695,46 @@ class MercurialAPI:
 		"""Returns the number of changes in this repository."""
 		raise Exception("Not implemented")
 
-	def changes( self, n=None ):
+	def changes( self, n=None, full=False ):
 		"""Yields the n (all by default) latest changes in this
-		repository. Each change is returned as a 'ChangeSet' instance."""
+		repository. Each change is returned as a 'ChangeSet' instance. Unless
+		@full is True, the changes files and description are only loaded when
+		accessed."""
+		raise Exception("Not implemented")
+
+	def details( self, start, end ):
+		"""Returns a dict mapping the revision numbers from @start to @end
+		(inclusive) to a '(FILES, DESCRIPTION)' couple."""
 		raise Exception("Not implemented")
 
+	def loadDetails( self, *changesets ):
+		"""Loads the files and description of the given changesets using a
+		single 'details' call per contiguous range of revisions. When a single
+		changeset is given, the details of the previous 'DETAILS_BATCH'
+		changesets are loaded as well, as listings go from the tip."""
+		lazy = self._lazy
+		nums = set(_.num for _ in changesets if _.num in lazy)
+		if len(changesets) == 1:
+			num = changesets[0].num
+			nums.update(_ for _ in range(max(0, num - DETAILS_BATCH + 1), num) if _ in lazy)
+		nums = sorted(nums)
+		while nums:
+			start = end = nums.pop(0)
+			while nums and nums[0] == end + 1: end = nums.pop(0)
+			for num, (files, description) in self.details(start, end).items():
+				if num in lazy: lazy.pop(num).setDetails(files, description)
+		for changeset in changesets:
+			if not changeset.hasDetails(): changeset.setDetails([], "")
+
+	def _lazyChanges( self, changes ):
+		"""Registers the given changes that miss details so that they are
+		loaded by this API when accessed, and returns them."""
+		for changeset in changes:
+			if not changeset.hasDetails():
+				changeset._loader = self
+				self._lazy[changeset.num] = changeset
+		return changes
+
 	def tip( self):
 		"""Returns the changeset number for the tip, as an integer"""
 		raise Exception("Not implemented")
@@ -544,6 +755,24 @@ class MercurialAPI:
 	def modifications( self ):
 		raise Exception("Not implemented")
 
+	def diffstats( self, revisions="0:tip", workers=None ):
+		"""Returns a dict mapping the node of each changeset in the given
+		@revisions (a revision range or revset) to a dict of the lines added and
+		removed for each file, as an '(ADDED, REMOVED)' couple. The @workers
+		tells how many processes can be used to compute the diffs."""
+		raise Exception("Not implemented")
+
+	def churn( self, revisions="0:tip", workers=None ):
+		"""Returns a dict mapping each file modified in the given @revisions to
+		the total lines added and removed, as an '(ADDED, REMOVED)' couple.
+		This uses the 'diffstats' operation."""
+		churn = {}
+		for stats in self.diffstats(revisions, workers).values():
+			for path, (added, removed) in stats.items():
+				total = churn.get(path, (0, 0))
+				churn[path] = (total[0] + added, total[1] + removed)
+		return churn
+
 	def tags( self ):
 		"""Returns tag name, rev and date for each tag within this repository."""
 		raise Exception("Not implemented")
@@ -556,20 +785,30 @@ class MercurialAPI:
 		"""Writes the given .hg/hgrc configuration file."""
 		raise Exception("Not implemented")
 
-	def _parseChangelog( self, changelog ):
+	def _parseChangelog( self, changelog, full=True ):
 		"""Parses Mercurial 'hg log -v' text output, and returns an array of
-		ChangeSet instances from that."""
+		ChangeSet instances from that. When @full is False, the output is
+		expected to be the one of 'hg log' (with a summary and no files), and
+		the changesets details are loaded lazily."""
 		repo_name = self._repo.name()
 		changeset = None
 		changes   = []
+		describing = False
 		for line in changelog:
 			if line.startswith("changeset:"):
 				if changeset: changes.append(changeset)
-				changeset = ChangeSet()
+				changeset = ChangeSet(None if full else self)
 				changeset.reponame = repo_name
 				line, c_num, c_id     = line.split(":",2)
 				changeset.num = int(c_num)
 				changeset.id  = c_id
+				describing    = False
+			elif describing:
+				if changeset.description[-2:] != "\n\n":
+					if changeset.summary == "":
+						changeset.summary = line
+					else:
+						changeset.description += (line + "\n")
 			elif line.startswith("user:"):
 				assert changeset
 				user = line.split(":", 1)[1].strip()
@@ -597,19 +836,34 @@ class MercurialAPI:
 				changeset.zone = zone
 			elif line.startswith("files:"):
 				changeset.files = line.split(":", 1)[1].strip().split()
+			elif line.startswith("summary:"):
+				changeset.summary = line.split(":", 1)[1].strip()
 			elif line.startswith("description:"):
-				pass
-			elif changeset:
-				if changeset and changeset.description[-2:] != "\n\n":
-					if changeset.summary == "":
-						changeset.summary = line
-					else:
-						changeset.description += (line + "\n")
+				describing = changeset is not None
 		if changes and changes[-1] != changeset:
 			if changeset: changes.append(changeset)
 		for c in  changes:
-			if c.description and c.description[-1] == "\n": c.description = c.description[:-1]
-		return changes
+			description = c.__dict__.get("description")
+			if description and description[-1] == "\n": c.description = description[:-1]
+		return self._lazyChanges(changes)
+
+	def _parseDetails( self, lines ):
+		"""Parses the output of 'hg log' using the 'DETAILS_TEMPLATE' and
+		returns a dict mapping revision numbers to '(FILES, DESCRIPTION)'."""
+		result  = {}
+		current = None
+		for line in lines:
+			if line.startswith(DETAILS_MARKER):
+				current = []
+				result[int(line[len(DETAILS_MARKER):])] = current
+			elif current is not None:
+				current.append(line)
+		for num, lines in result.items():
+			files = lines and lines[0].split() or []
+			# The description excludes the summary, like in '_parseChangelog'
+			description = "\n".join(lines[2:]).rstrip("\n")
+			result[num] = (files, description)
+		return result
 
 	def _parseTags( self, tagslist ):
 		result = []
@@ -651,9 +905,7 @@ class MercurialLocal(MercurialAPI):
 		self._tags    = None
 		self._hg      = "hg"
 		self._lastTip = None
-
-	def _start( self ):
-		self._startShell()
+		self._diffstats = None
 
 	def _stop( self ):
 		self._stopShell()
@@ -668,9 +920,9 @@ class MercurialLocal(MercurialAPI):
 	# _________________________________________________________________________
 
 	def _startShell( self, shell="sh" ):
+		# NOTE: The shell is started by the first command, not when binding
 		self._shout, self._shin = popen2.popen4(shell)
 		self._doCommand("cd " + self._repo.path())
-		current = self._doCommand("pwd")[0]
 		# TODO: Check for hg
 		# TODO: Check for python
 
@@ -699,22 +951,30 @@ class MercurialLocal(MercurialAPI):
 	# API IMPLEMENTATION
 	# _________________________________________________________________________
 
-	def changes( self, n=None ):
-		command = " log -v"
+	def changes( self, n=None, full=False ):
+		command = full and " log -v" or " log"
 		tip     = self.tip()
 		if not self._changes:
-			self._changes = self._parseChangelog( self._doHG(command) )
+			self._changes = self._parseChangelog( self._doHG(command), full )
 		elif self._lastTip != tip:
 			command += " -r tip:%d" % (self._lastTip + 1)
-			for change in self._parseChangelog( self._doHG(command) ):
+			for change in self._parseChangelog( self._doHG(command), full ):
 				self._changes.append(change)
 		self._lastTip = tip
 		if n == 1:
-			return self._changes[0]
+			result = self._changes[0]
 		elif n != None:
-			return self._changes[:n]
+			result = self._changes[:n]
 		else:
-			return self._changes
+			result = self._changes
+		if full:
+			lazy = [_ for _ in (n == 1 and [result] or result) if not _.hasDetails()]
+			if lazy: self.loadDetails(*lazy)
+		return result
+
+	def details( self, start, end ):
+		return self._parseDetails(self._doHG("log", "-r %d:%d" % (start, end),
+		"--template '%s'" % (DETAILS_TEMPLATE)))
 
 	def signatures( self, changeset ):
 		"""Returns the signatures for the content of the files modified by the
@@ -749,6 +1009,58 @@ class MercurialLocal(MercurialAPI):
 			self._modifications = self._parseStatus( self._doHG(" status"))
 		return self._modifications
 
+	def diffstats( self, revisions="0:tip", workers=None ):
+		nodes   = [_ for _ in self._doHG("log", "-r '%s'" % (revisions), "--template '{node}\\n'") if _]
+		cache   = self._diffstatsCache()
+		missing = [_ for _ in nodes if _ not in cache]
+		if missing:
+			for node, stats in self._diffstatsFetch(missing, workers):
+				cache[node] = stats
+			self._diffstatsSave()
+		return dict((_, cache.get(_, {})) for _ in nodes)
+
+	def _diffstatsFetch( self, nodes, workers=None ):
+		"""Computes the diffstats for the given changeset nodes, spreading
+		chunks of changesets over a pool of processes."""
+		root   = self._repo.path()
+		chunks = [(self._hg, root, nodes[i:i + DIFFSTAT_CHUNK]) for i in range(0, len(nodes), DIFFSTAT_CHUNK)]
+		if len(chunks) == 1 or workers == 1:
+			results = map(_diffstat_worker, chunks)
+		else:
+			pool = multiprocessing.Pool(workers)
+			try:
+				results = pool.map(_diffstat_worker, chunks)
+			finally:
+				pool.close()
+				pool.join()
+		return [_ for result in results for _ in result]
+
+	def _diffstatsPath( self ):
+		return os.path.join(self._repo.path(), ".hg", DIFFSTAT_CACHE)
+
+	def _diffstatsCache( self ):
+		"""Returns the diffstats cache, mapping changeset nodes to their
+		diffstats, loading it from the repository if necessary."""
+		if self._diffstats is None:
+			self._diffstats = {}
+			path = self._diffstatsPath()
+			if path and os.path.exists(path):
+				try:
+					with open(path, "rb") as f:
+						self._diffstats = pickle.load(f)
+				except Exception:
+					# The cache is corrupted, so we start over
+					pass
+		return self._diffstats
+
+	def _diffstatsSave( self ):
+		path = self._diffstatsPath()
+		if not path: return
+		temp = path + ".tmp"
+		with open(temp, "wb") as f:
+			pickle.dump(self._diffstats, f, pickle.HIGHEST_PROTOCOL)
+		os.rename(temp, path)
+
 	def count( self ):
 		return len(self._changes)
 
@@ -772,14 +1084,96 @@ class MercurialLocal(MercurialAPI):
 #
 # ------------------------------------------------------------------------------
 
+# This script is run by the remote Python when the SSH transfer is compressed.
+# It outputs zlib-compressed data as length-prefixed frames, terminated by an
+# empty frame. In 'zip' mode, it compresses its input, and in 'cat' mode it
+# outputs a 'NODE STATUS' header line followed by the file content, or by a
+# delta ('C' copy base lines and 'I' insert data records) to the base revision.
+REMOTE_SCRIPT = """\
+import sys, os, zlib, struct, subprocess, difflib, itertools
+out = getattr(sys.stdout, "buffer", sys.stdout)
+def run(*command):
+	p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	data = p.communicate()[0]
+	if p.returncode == 0: return data
+	return None
+def frame(data):
+	if data: out.write(struct.pack(">I", len(data)) + data)
+def send(chunks):
+	z = zlib.compressobj(6)
+	for chunk in chunks: frame(z.compress(chunk))
+	frame(z.flush())
+	out.write(struct.pack(">I", 0))
+	out.flush()
+def delta(a, b):
+	a = a.splitlines(True)
+	b = b.splitlines(True)
+	for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b).get_opcodes():
+		if tag == "equal":
+			yield b"C" + struct.pack(">II", i1, i2)
+		elif j2 > j1:
+			data = b"".join(b[j1:j2])
+			yield b"I" + struct.pack(">I", len(data)) + data
+def cat(hg, rev, base, path):
+	node = (run(hg, "log", "-r", rev, "--template", "{node}") or b"").strip()
+	content = run(hg, "cat", "-r", rev, path)
+	if content is None: return [node + b" missing\\n"]
+	if node == base.encode(): return [node + b" same\\n"]
+	previous = None
+	if base != "-": previous = run(hg, "cat", "-r", base, path)
+	if previous is None: return [node + b" full\\n", content]
+	return itertools.chain([node + b" delta\\n"], delta(previous, content))
+if sys.argv[1] == "zip": send(iter(lambda: os.read(0, 65536), b""))
+else: send(cat(*sys.argv[2:6]))
+"""
+
+BLOB_CACHE_SIZE = 64
+FRAME_MAX_SIZE  = 64 * 1024 * 1024
+
+class SSHTransferError(Exception): pass
+
+def apply_delta( base, delta ):
+	"""Applies the given delta (as produced by the 'cat' mode of the
+	'REMOTE_SCRIPT') to the given base content, and returns the new content."""
+	lines  = base.splitlines(True)
+	result = []
+	offset = 0
+	while offset < len(delta):
+		record = delta[offset]
+		if record == "C":
+			start, end = struct.unpack(">II", delta[offset+1:offset+9])
+			result.extend(lines[start:end])
+			offset += 9
+		elif record == "I":
+			size = struct.unpack(">I", delta[offset+1:offset+5])[0]
+			result.append(delta[offset+5:offset+5+size])
+			offset += 5 + size
+		else:
+			raise SSHTransferError("Malformed delta record: %r" % (record))
+	return "".join(result)
+
 class MercurialSSH(MercurialLocal):
 	"""This class implements methods for interacting with a Mercurial repository
-	through the SSH protocol."""
+	through the SSH protocol.
+
+	When @compress is True (or when 'easyhg.compress' is set in the Mercurial
+	configuration), the output of the commands is compressed on the remote
+	side, which requires Python there. Files retrieved with 'fileCat' are then
+	cached, so that retrieving another revision of them only transfers a delta."""
 
 	END_TOKEN = "@@MERCURIAL_SSH_END@@"
 
-	def __init__( self, repo ):
+	def __init__( self, repo, compress=None ):
 		MercurialLocal.__init__(self, repo)
+		self._compress = compress
+		self._python   = "python"
+		self._blobs    = collections.OrderedDict()
+
+	def isCompressed( self ):
+		"""Tells if the transfers are compressed."""
+		if self._compress is None:
+			self._compress = self._repo._ui.configbool("easyhg", "compress", False)
+		return self._compress
 
 	def _sshParameters( self ):
 		# This returns the proper SSH arguments to for the repository location
@@ -789,6 +1183,229 @@ class MercurialSSH(MercurialLocal):
 		return args
 
 	def _startShell( self, shell="sh" ):
-		MercurialLocal._startShell(self, "ssh %s %s" % (self._sshParameters(), shell))
+		ssh = self._repo._ui.config("ui", "ssh") or "ssh"
+		MercurialLocal._startShell(self, "%s %s %s" % (ssh, self._sshParameters(), shell))
+
+	# COMPRESSED TRANSFER
+	# _________________________________________________________________________
+
+	def _remote( self, *args ):
+		"""Returns the command that runs the 'REMOTE_SCRIPT' with the given
+		arguments."""
+		return "%s -c 'import base64;exec(base64.b64decode(\"%s\"))' %s 2>/dev/null" % (
+			self._python, base64.b64encode(REMOTE_SCRIPT), " ".join(args))
+
+	def _doCompressed( self, cmd ):
+		"""Runs the given command, which must output frames of compressed data
+		(see 'REMOTE_SCRIPT'), and returns the data decompressed as the frames
+		arrive. None is returned when the remote side could not compress."""
+		if self._shout == None: self._startShell()
+		self._shin.write(cmd + "\n")
+		self._shin.write("echo %s\n" % (self.END_TOKEN))
+		self._shin.flush()
+		decompressor = zlib.decompressobj()
+		result       = []
+		while True:
+			header = self._shout.read(FRAME_HEADER.size)
+			if self.END_TOKEN.startswith(header):
+				# There are no frames, which means the remote script failed
+				self._shout.readline()
+				return None
+			size = FRAME_HEADER.unpack(header)[0]
+			if size == 0: break
+			if size > FRAME_MAX_SIZE:
+				raise SSHTransferError("Malformed frame of %d bytes" % (size))
+			result.append(decompressor.decompress(self._shout.read(size)))
+		result.append(decompressor.flush())
+		while not self._shout.readline().strip().endswith(self.END_TOKEN): pass
+		return "".join(result)
+
+	def _uncompressed( self ):
+		self._repo._ui.warn("Compressed transfer not available, remote Python is required\n")
+		self._compress = False
+
+	def _doHG( self, cmd, *args ):
+		if not self.isCompressed():
+			return MercurialLocal._doHG(self, cmd, *args)
+		command = "%s %s %s 2>&1 | %s" % (self._hg, cmd, " ".join(map(str, args)), self._remote("zip"))
+		output  = self._doCompressed(command)
+		if output is None:
+			self._uncompressed()
+			return MercurialLocal._doHG(self, cmd, *args)
+		lines = output.split("\n")
+		if lines and not lines[-1]: lines.pop()
+		return lines
+
+	def fileCat( self, path, revision="tip" ):
+		if not self.isCompressed():
+			return MercurialLocal.fileCat(self, path, revision)
+		cached = self._blobs.pop(path, None)
+		base   = cached and cached[0] or "-"
+		output = self._doCompressed(self._remote("cat", self._hg, "'%s'" % (revision), base, "'%s'" % (path)))
+		if output is None:
+			self._uncompressed()
+			return MercurialLocal.fileCat(self, path, revision)
+		header, body = output.split("\n", 1)
+		node, status = header.split(" ", 1)
+		if   status == "missing":
+			return None
+		elif status == "same":
+			content = cached[1]
+		elif status == "delta":
+			content = apply_delta(cached[1], body)
+		else:
+			content = body
+		self._blobs[path] = (node, content)
+		while len(self._blobs) > BLOB_CACHE_SIZE: self._blobs.popitem(last=False)
+		return content
+
+	def _diffstatsFetch( self, nodes, workers=None ):
+		# The diffs go through the SSH shell, so there is no process pool
+		result = []
+		for i in range(0, len(nodes), DIFFSTAT_CHUNK):
+			lines = self._doHG("log --git -p", "--template '%s{node}\\n'" % (DIFFSTAT_MARKER),
+			*["-r" + _ for _ in nodes[i:i + DIFFSTAT_CHUNK]])
+			result.extend(parse_diffstat(lines))
+		return result
+
+	def _diffstatsPath( self ):
+		# The cache is kept in memory, and is persisted with 'Repository.store'
+		return None
+
+# ------------------------------------------------------------------------------
+#
+# MERCURIAL DAEMON API
+#
+# ------------------------------------------------------------------------------
+
+DAEMON_SOCKET = "easyhg.sock"
+FRAME_HEADER  = struct.Struct(">I")
+
+class DaemonError(Exception): pass
+
+def daemon_socket( path ):
+	"""Returns the path of the Unix socket used by the daemon serving the
+	repository at the given path."""
+	return os.path.join(path, ".hg", DAEMON_SOCKET)
+
+def daemon_connect( path ):
+	"""Returns a socket connected to the daemon serving the repository at the
+	given path, or None if there is no such daemon."""
+	path = daemon_socket(path)
+	if not os.path.exists(path): return None
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(path)
+	except socket.error:
+		sock.close()
+		return None
+	return sock
+
+def send_frame( sock, data ):
+	"""Sends the given data through the socket as a frame, which is the
+	pickled data prefixed by its length as a 32-bit big-endian integer."""
+	payload = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+	sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+def recv_frame( sock ):
+	"""Receives a frame sent with 'send_frame' and returns its data, or None
+	if the connection was closed."""
+	header = _recv_exactly(sock, FRAME_HEADER.size)
+	if header is None: return None
+	payload = _recv_exactly(sock, FRAME_HEADER.unpack(header)[0])
+	if payload is None: return None
+	return pickle.loads(payload)
+
+def _recv_exactly( sock, size ):
+	chunks    = []
+	remaining = size
+	while remaining > 0:
+		chunk = sock.recv(min(remaining, 65536))
+		if not chunk: return None
+		chunks.append(chunk)
+		remaining -= len(chunk)
+	return "".join(chunks)
+
+class MercurialDaemon(MercurialAPI):
+	"""This class forwards the API calls to an 'easyhg.daemon' process that
+	serves the repository over a Unix socket, and keeps the changes, tags and
+	status warm between invocations. Use 'MercurialDaemon.connect' to get an
+	instance, as it returns None when no daemon is running.
+
+	When the daemon goes away (for instance after its idle timeout), the
+	repository is transparently switched back to a 'MercurialLocal' API."""
+
+	METHODS = ("count", "changes", "fileCat", "fileSig", "tip", "tags",
+	"modifications", "diffstats", "details", "readConfiguration",
+	"writeConfiguration")
+
+	def __init__( self, repo, sock ):
+		MercurialAPI.__init__(self, repo)
+		self._socket = sock
+
+	@classmethod
+	def connect( cls, repo, path ):
+		"""Returns a new API connected to the daemon serving the repository
+		at the given path, or None if there is no such daemon."""
+		sock = daemon_connect(path)
+		return sock and cls(repo, sock)
+
+	def _call( self, method, *args, **kwargs ):
+		try:
+			send_frame(self._socket, (method, args, kwargs))
+			response = recv_frame(self._socket)
+		except socket.error:
+			response = None
+		if response is None:
+			return self._fallback(method, *args, **kwargs)
+		success, value = response
+		if not success: raise DaemonError(value)
+		return value
+
+	def _fallback( self, method, *args, **kwargs ):
+		"""Switches the repository to the direct API and invokes the given
+		method on it."""
+		self._socket.close()
+		self._repo.api = api = MercurialLocal(self._repo)
+		api.bind(self._repo)
+		return getattr(api, method)(*args, **kwargs)
+
+	# API IMPLEMENTATION
+	# _________________________________________________________________________
+
+	def count( self ):
+		return self._call("count")
+
+	def changes( self, n=None, full=False ):
+		changes = self._call("changes", n, full)
+		self._lazyChanges(n == 1 and [changes] or changes)
+		return changes
+
+	def details( self, start, end ):
+		return self._call("details", start, end)
+
+	def fileCat( self, path, revision="tip" ):
+		return self._call("fileCat", path, revision)
+
+	def fileSig( self, path, revision="tip" ):
+		return self._call("fileSig", path, revision)
+
+	def tip( self ):
+		return self._call("tip")
+
+	def tags( self ):
+		return self._call("tags")
+
+	def modifications( self ):
+		return self._call("modifications")
+
+	def diffstats( self, revisions="0:tip", workers=None ):
+		return self._call("diffstats", revisions, workers)
+
+	def readConfiguration( self ):
+		return self._call("readConfiguration")
+
+	def writeConfiguration( self, text ):
+		return self._call("writeConfiguration", text)
 
 # EOF - vim: tw=80 ts=4 sw=4 noet
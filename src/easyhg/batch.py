@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# Encoding: utf8
+# -----------------------------------------------------------------------------
+# Project   : Mercurial - Easycommit
+# License   : GNU Public License         <http://www.gnu.org/licenses/gpl.html>
+# -----------------------------------------------------------------------------
+# Author    : Sébastien Pierre                           <sebastien@type-z.org>
+# -----------------------------------------------------------------------------
+# Creation  : 19-Oct-2026
+# Last mod  : 19-Oct-2026
+# -----------------------------------------------------------------------------
+
+import sys, os, json, tempfile, subprocess, threading, Queue
+
+__version__  = "0.9.8"
+PROGRAM_NAME = "easycommit-batch"
+__doc__      = """\
+Commits without the Easycommit user interface, from the same structured
+messages ('tags', 'scope', 'summary', 'description') that Easycommit saves in
+'.hgcommit'. The messages are validated and formatted with the same rules as
+the user interface, and a batch of repositories is committed concurrently.
+
+This module does not import 'urwid' nor Mercurial, and runs 'hg' commands.
+"""
+
+USAGE = """\
+%s %s
+
+Usage: %s [--jobs=N] [FILE|-]
+
+Reads a JSON commit (or a list of commits) from FILE, or from stdin when FILE
+is '-' or missing, and prints the JSON list of results. Each commit is like
+
+    {
+      "repository"  : "path/to/repository",   (default ".")
+      "tags"        : ["Update"],             (or "Update Fix")
+      "scope"       : "api",
+      "summary"     : "One-line summary",     (required)
+      "description" : "Details",
+      "user"        : "Name <email>",
+      "files"       : ["changed/file"],       (default all the changes)
+      "rev"         : ["42"]                  (working copy parents)
+    }
+""" % (PROGRAM_NAME, __version__, PROGRAM_NAME)
+
+PLACEHOLDER = "‥"
+FIELDS      = ("repository", "tags", "scope", "summary", "description", "user", "files", "rev")
+WORKERS     = 8
+
+class MessageError(Exception): pass
+
+# ------------------------------------------------------------------------------
+#
+# MESSAGES
+#
+# ------------------------------------------------------------------------------
+
+def normalize_message( summary="", scope="", tags="", description="" ):
+	"""Returns the structured message for the given field values, as typed in
+	the Easycommit fields: placeholders are dropped and tags are split."""
+	if scope.startswith(PLACEHOLDER):       scope       = ""
+	if description.startswith(PLACEHOLDER): description = ""
+	if tags and not isinstance(tags, list):
+		tags = [_.strip() for _ in tags.split() if _.strip()]
+	return dict(
+		summary     = summary,
+		scope       = scope,
+		tags        = tags,
+		description = description
+	)
+
+def format_message( summary="", scope="", tags="", description="" ):
+	"""Formats the given structured message as a commit message, which is
+	like '[TAG][TAG] SCOPE: SUMMARY' followed by the description."""
+	if tags:
+		tags = "".join("[{0}]".format(_) for _ in tags)
+	msg = "{0} {1}{2}{3}".format(
+		tags,
+		scope + ": " if scope else "",
+		summary,
+		"\n\n" + description if description else ""
+	)
+	while msg.find("\n\n") != -1: msg = msg.replace("\n\n", "\n")
+	return msg
+
+def validate( commit ):
+	"""Validates the given commit (as decoded from JSON), raising a
+	'MessageError' when it is invalid, and returns it normalized, with UTF-8
+	encoded strings."""
+	if not isinstance(commit, dict):
+		raise MessageError("Commit must be an object, got: %r" % (commit,))
+	commit = dict((k, _encode(v)) for k, v in commit.items())
+	unknown = [_ for _ in commit if _ not in FIELDS]
+	if unknown:
+		raise MessageError("Unknown fields: %s" % (", ".join(unknown)))
+	for name in ("repository", "scope", "summary", "description", "user"):
+		if not isinstance(commit.get(name) or "", basestring):
+			raise MessageError("Field '%s' must be a string" % (name))
+	for name in ("files", "rev"):
+		value = commit.get(name)
+		if value is not None and not (isinstance(value, list) and all(isinstance(_, basestring) for _ in value)):
+			raise MessageError("Field '%s' must be a list of strings" % (name))
+	tags = commit.get("tags") or ""
+	if not (isinstance(tags, basestring) or isinstance(tags, list) and all(isinstance(_, basestring) for _ in tags)):
+		raise MessageError("Field 'tags' must be a string or a list of strings")
+	message = normalize_message(
+		summary     = (commit.get("summary") or "").strip(),
+		scope       = (commit.get("scope") or "").strip(),
+		tags        = tags,
+		description = (commit.get("description") or "").strip()
+	)
+	if not message["summary"] or message["summary"].startswith(PLACEHOLDER):
+		raise MessageError("A summary is required")
+	if "\n" in message["summary"]:
+		raise MessageError("The summary must be a single line")
+	result = dict(commit)
+	result.update(message)
+	result["repository"] = commit.get("repository") or "."
+	return result
+
+def _encode( value ):
+	if isinstance(value, unicode): return value.encode("utf8")
+	if isinstance(value, list):    return map(_encode, value)
+	return value
+
+# ------------------------------------------------------------------------------
+#
+# REPOSITORIES
+#
+# ------------------------------------------------------------------------------
+
+def hg( root, *args ):
+	"""Runs the given 'hg' command in the repository at the given root,
+	returning its output and raising an 'OSError' when it fails."""
+	process = subprocess.Popen(("hg", "--repository", root) + args,
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=root)
+	out, err = process.communicate()
+	if process.returncode != 0:
+		raise OSError("hg %s failed: %s" % (args[0], (err or out).strip()))
+	return out
+
+def parents( root ):
+	"""Returns the working copy parents, like 'Commit.current'."""
+	revs = hg(root, "parents", "--template", "{rev}\n").split()
+	return revs or ["tip"]
+
+def changes( root ):
+	"""Returns the paths that Easycommit would list for the repository: the
+	modified, added and removed ones."""
+	return [_[2:] for _ in hg(root, "status", "-mar", "-0").split("\0") if _]
+
+def commit( job ):
+	"""Commits the given validated job, returning a result dictionary with
+	'repository', 'status' ('committed', 'unchanged' or 'error') and either
+	'node' or 'error'."""
+	root   = os.path.abspath(job["repository"])
+	result = {"repository":job["repository"]}
+	try:
+		if job.get("rev") is not None and job["rev"] != parents(root):
+			raise MessageError("Working copy parents are %s, not %s" % (parents(root), job["rev"]))
+		changed = changes(root)
+		files   = job.get("files")
+		if files is None:
+			files = changed
+		else:
+			unknown = set(files) - set(changed)
+			if unknown:
+				raise MessageError("Files without changes: %s" % (", ".join(sorted(unknown))))
+		if not files:
+			result["status"] = "unchanged"
+			return result
+		args = ["commit", "--message", format_message(job["summary"], job["scope"], job["tags"], job["description"])]
+		if job.get("user"): args += ["--user", job["user"]]
+		# The files are given as a list file, as there may be many of them
+		fd, listfile = tempfile.mkstemp(prefix="easycommit-")
+		try:
+			os.write(fd, "\0".join(files))
+			os.close(fd)
+			hg(root, *(args + ["listfile0:" + listfile]))
+		finally:
+			os.unlink(listfile)
+		result["status"] = "committed"
+		result["node"]   = hg(root, "log", "--rev", ".", "--template", "{node}")
+	except (MessageError, OSError) as e:
+		result["status"] = "error"
+		result["error"]  = str(e)
+	return result
+
+def commit_all( jobs, workers=WORKERS ):
+	"""Commits the given validated jobs with a bounded pool of @workers
+	threads, returning the results in the order of the jobs. The jobs for
+	the same repository are run one after the other."""
+	pending = Queue.Queue()
+	results = [None] * len(jobs)
+	groups  = {}
+	for i, job in enumerate(jobs):
+		groups.setdefault(os.path.abspath(job["repository"]), []).append((i, job))
+	for group in groups.values(): pending.put(group)
+	def worker():
+		while True:
+			try:
+				group = pending.get_nowait()
+			except Queue.Empty:
+				return
+			for i, job in group:
+				results[i] = commit(job)
+	threads = [threading.Thread(target=worker) for _ in range(min(workers, len(groups)))]
+	for thread in threads: thread.start()
+	for thread in threads: thread.join()
+	return results
+
+# -----------------------------------------------------------------------------
+#
+# MAIN
+#
+# -----------------------------------------------------------------------------
+
+def run( args, stdin=sys.stdin, stdout=sys.stdout ):
+	"""Runs the batch with the given arguments, returning 0 when all the
+	commits succeeded."""
+	workers = WORKERS
+	paths   = []
+	for arg in args:
+		if arg.startswith("--jobs="):
+			workers = max(1, int(arg.split("=", 1)[1]))
+		elif arg in ("-h", "--help"):
+			stdout.write(USAGE)
+			return 0
+		else:
+			paths.append(arg)
+	if len(paths) > 1:
+		stdout.write(USAGE)
+		return -1
+	try:
+		if not paths or paths[0] == "-":
+			data = json.load(stdin)
+		else:
+			with open(paths[0]) as f:
+				data = json.load(f)
+	except ValueError as e:
+		sys.stderr.write("Invalid JSON: %s\n" % (e))
+		return -1
+	jobs    = data if isinstance(data, list) else [data]
+	results = [None] * len(jobs)
+	valid   = []
+	# Invalid commits are reported without running anything
+	for i, job in enumerate(jobs):
+		try:
+			valid.append((i, validate(job)))
+		except MessageError as e:
+			results[i] = {"repository":isinstance(job, dict) and job.get("repository") or ".",
+				"status":"error", "error":str(e)}
+	for (i, job), result in zip(valid, commit_all([job for _, job in valid], workers)):
+		results[i] = result
+	json.dump(results, stdout, indent=2)
+	stdout.write("\n")
+	return 0 if all(_["status"] != "error" for _ in results) else 1
+
+if __name__ == "__main__":
+	sys.exit(run(sys.argv[1:]))
+
+# EOF - vim: tw=80 ts=4 sw=4 noet
@@ -10,16 +10,10 @@
 # Last mod  : 22-Jan-2017
 # -----------------------------------------------------------------------------
 
-import sys, os, re, time, stat, tempfile, json
-import easyhg.mergetool as mergetool
+import sys, os, re, time, stat, shutil, tempfile, json, subprocess, threading, Queue
+import bisect
 from   copy import copy
 from   fnmatch import fnmatch
-import urwide, urwid
-from   mercurial.i18n import gettext as _
-import mercurial.match
-import mercurial.commands
-import mercurial.cmdutil
-import mercurial.localrepo
 from easyhg.output import *
 
 # TODO: Support --amend
@@ -36,280 +30,20 @@ __doc__     = """\
 Easycommit is a tool that allows better, richer, more structured commits for
 Mercurial. It eases the life of the developers and enhances the quality and
 consistency of commits.
-"""
 
-# ------------------------------------------------------------------------------
-#
-# CONSOLE INTERFACE
-#
-# ------------------------------------------------------------------------------
-DEFAULT_TAGS  = [
-	"Release",
-	"New",
-	"Update",
-	"Change",
-	"Feature",
-	"Refactor",
-	"Fix",
-	"WIP"
-	"Merge",
-	"Submodules",
-]
-
-CONSOLE_STYLE = """\
-Frame         : WH, DB, SO
-header        : WH, DC, BO
-footer        : WH, DB, SO
-info          : BL, DC, SO
-tooltip       : Lg, DB, BO
-
-label         : Lg, DB, SO
-title         : WH, DB, BO
-
-Edit          : WH, DB, BO
-Edit*         : WH, DM, BO
-Button        : LC, DB, BO
-Button*       : WH, DM, BO
-CheckBox      : Lg, DB, SO
-CheckBox*     : Lg, DM, SO
-Divider       : DC, DB, SO
-Text          : Lg, DB, SO
-Text*         : WH, DM, BO
-
-#edit_summary : YL, DB, SO
+As this module is loaded by Mercurial for every command once the extension is
+enabled, it only defines the commit model: the user interface (see
+'easyhg.commitui') and Mercurial's commands are imported when 'easycommit'
+actually runs.
 """
 
-CONSOLE_UI = """\
-Hdr MERCURIAL - Easycommit %s
-
-Edt Name          [$USERNAME]               #edit_user
-Edt Tags          [Update]                  #edit_tags    ?TAGS    &key=tag
-Edt Scope         [‥]                       #edit_scope   ?SCOPE   &key=scope
-Edt Summary       [‥]                       #edit_summary ?SUMMARY &key=sumUp
-Dvd ___
-
-Box
-  Edt [‥]                                   #edit_desc    ?DESC &key=describe multiline=True
-End
-
-Dvd ___
-
-Ple                                         #changes
-End
-Dvd ___
-
-GFl
-	Btn [Cancel]                            #btn_cancel  &press=cancel
-	Btn [Commit]                            #btn_commit  &press=commit
-End
-
-	""" % (__version__)
-
-class ConsoleUI:
-	"""Main user interface for commit."""
-
-	def __init__(self):
-		self.ui = urwide.Console()
-		self.defaultHandler = ConsoleUIHandler()
-		self.ui.handler(self.defaultHandler)
-		self.ui.strings.DESC    = "Describe your changes in detail here"
-		self.ui.strings.SUMMARY = "Give a one-line summary of your changes"
-		self.ui.strings.TAGS    = "Enter tags [+] and [-] to cycle through available tags"
-		self.ui.strings.SCOPE   = "Enter the scope of the the change"
-		self.ui.strings.CHANGE  = "[V]iew [C]ommit [S]ave [Q]uit"
-
-	def main( self, commit = None ):
-		self.ui.create(CONSOLE_STYLE, CONSOLE_UI)
-		message = (commit.load() if commit else {}) or {}
-		self.ui.DEFAULT_SUMMARY     = message.get("summary")     or self.ui.widgets.edit_summary.get_edit_text()
-		self.ui.DEFAULT_DESCRIPTION = message.get("description") or self.ui.widgets.edit_desc.get_edit_text()
-		self.ui.DEFAULT_SCOPE       = message.get("scope")       or self.ui.widgets.edit_scope.get_edit_text()
-		if commit and len(commit.revs) > 1:
-			self.ui.DEFAULT_TAGS = "[Merge]"
-		self.ui.data.commit = commit
-		if commit:
-			if commit.changed(".hgsub*") or commit.added(".hgsub*") or commit.empty():
-				self.ui.widgets.edit_tags.set_edit_text("Submodules")
-			self.defaultHandler.updateCommitFiles()
-		return self.ui.main()
-
-	def selectedChanges(self):
-		return self.defaultHandler.selectedChanges()
-
-	def commitMessage( self, json=False ):
-		summ  = self.ui.widgets.edit_summary.get_edit_text()
-		scope = self.ui.widgets.edit_scope.get_edit_text()
-		tags  = self.ui.widgets.edit_tags.get_edit_text()
-		desc  = self.ui.widgets.edit_desc.get_edit_text()
-		if scope.startswith("‥"): scope = ""
-		if desc.startswith("‥"):  desc  = ""
-		if tags:
-			tags = [_.strip() for _ in tags.split() if _.strip]
-		if json:
-			return dict(
-				summary     = summ,
-				scope       = scope,
-				tags        = tags,
-				description = desc
-			)
-		else:
-			if tags:
-				tags = "".join("[{0}]".format(_) for _ in tags)
-			msg = "{0} {1}{2}{3}".format(
-				tags,
-				scope + ": " if scope else "",
-				summ,
-				"\n\n" + desc if desc else ""
-			)
-			while msg.find("\n\n") != -1: msg = msg.replace("\n\n", "\n")
-			return msg
-
-	def commitUser( self ):
-		return self.ui.widgets.edit_user.get_edit_text()
-
-class ConsoleUIHandler(urwide.Handler):
-	"""Main event handler."""
-
-	def onSave( self, button ):
-		self.ui.tooltip("Save")
-
-	def onCancel( self, button ):
-		self.ui.tooltip("Cancel")
-		self.ui.end("Commit canceled",status=False)
-
-	def onCommit( self, button ):
-		self.ui.tooltip("Commit")
-		self.ui.end()
-
-	def onSumUp( self, widget, key ):
-		if hasattr(widget, "_alreadyEdited"): return False
-		if key in ("left", "right", "up", "down", "tab", "shift tab"): return False
-		widget.set_edit_text("" + (key if len(key) == 1 else ""))
-		widget._alreadyEdited = True
-
-	def onScope( self, widget, key ):
-		return self.onSumUp(widget, key)
-
-	def onDescribe( self, widget, key ):
-		return self.onSumUp(widget, key)
-
-	def isTag( self, tagname ):
-		"""Tells wether the given @tagname (as text) is a tag from the
-		@DEFAULT_TAGS and returns the indice of the tag in the array. The tag
-		matches if on of the @DEFAULT_TAGS start with the given tagname."""
-		i = 0
-		for tag in DEFAULT_TAGS:
-			if tagname.lower() == tag.lower():
-				return i
-			i += 1
-		i = 0
-		for tag in DEFAULT_TAGS:
-			if tag.lower().startswith(tagname.lower()):
-				if i == 0: return len(DEFAULT_TAGS) - 1
-				else: return i- 1
-			i += 1
-		return -1
-
-	def onTag( self, widget, key ):
-		# This takes into account tag completion
-		if key in ( "+", "-" ):
-			if key == "+":
-				offset  = 1
-				default = -1
-			else:
-				offset  = -1
-				default = 0
-			o = widget.edit_pos
-			t = widget.get_edit_text()
-			current_tag = len(map(lambda x:x.strip(), t[:o].strip().split())) -1
-			tags = map(lambda x:x.strip(), t.strip().split())
-			if tags:
-				i = self.isTag(tags[current_tag])
-				i = (i+ offset) % len(DEFAULT_TAGS)
-				tooltip = "Available tags: %s [%s] %s" % (
-					" ".join(DEFAULT_TAGS[:i]),
-					DEFAULT_TAGS[i].upper(),
-					" ".join(DEFAULT_TAGS[i+1:])
-				)
-				self.ui.tooltip(tooltip)
-				tags[current_tag] = (DEFAULT_TAGS[i])
-			else:
-				tags.append(DEFAULT_TAGS[default])
-			widget.set_edit_text(" ".join(tags))
-			widget._alreadyEdited = True
-			return True
-		if not hasattr(widget, "_alreadyEdited"):
-			if key in ("left", "right", "up", "down", "tab", "shift tab"): return False
-			widget.set_edit_text("")
-			widget._alreadyEdited = True
-			return False
-		else:
-			return False
-
-	def onChangeInfo( self, widget ):
-		self.ui.tooltip(widget.commitEvent.info())
-		self.ui.info(self.ui.strings.CHANGE)
-
-	def onChange( self, widget, key ):
-		if key == "v":
-			self.reviewFile(widget.commitEvent)
-		else:
-			return False
-
-	def onKeyPress( self, widget, key ):
-		if key in ("q", "esc"):
-			self.onCancel(widget)
-		elif key == "s":
-			self.onSave(widget)
-		elif key == "c":
-			self.onCommit(widget)
-		else:
-			return False
-
-	# SPECIFIC ACTIONS
-	# _________________________________________________________________________
-
-	def updateCommitFiles(self):
-		commit = self.ui.data.commit
-		# Cleans up the existing widgets
-		changes = self.ui.widgets.changes
-		urwide.remove_widgets(changes)
-		widgets = []
-		# Iterates on evnets and registers checkboxes
-		for event in commit.events:
-			checkbox = self.ui.new(urwid.CheckBox, "%-10s %s" %(event.name, event.path), True)
-			self.ui.unwrap(checkbox).commitEvent = event
-			urwide.add_widget(changes, self.ui.wrap(checkbox, "?CHANGE &focus=changeInfo"))
-			self.ui.onFocus(checkbox, "changeInfo")
-			self.ui.onKey(checkbox, "change")
-		if commit.events:
-			# When only the .hgsubstate has changed, we might have 0 events
-			self.ui.widgets.changes.set_focus(0)
-
-	def reviewFile( self, commitEvent ):
-		parent_rev = commitEvent.parentRevision()
-		fd, path   = tempfile.mkstemp(prefix="hg-commit")
-		if not parent_rev: parent_rev = ""
-		os.write(fd, parent_rev)
-		self.ui.tooltip("Reviewing differences for " + commitEvent.path)
-		self.ui.draw()
-		mergetool.review(commitEvent.abspath(), path)
-		os.close(fd)
-		os.unlink(path)
-
-	def selectedChanges( self ):
-		"""Returns the list of selected change events."""
-		events = []
-		for checkbox in map(self.ui.unwrap, self.ui.widgets.changes.widget_list):
-			if not checkbox.state: continue
-			events.append(checkbox.commitEvent)
-		return events
-
 # ------------------------------------------------------------------------------
 #
 # COMMIT OBJECT
 #
 # ------------------------------------------------------------------------------
+DIFFSTAT_WIDTH = 50
+
 # NOTE: We decided to wrap the current Mercurial commit datastructure into an OO
 # layer that eases the manipulation of the commit data.
 
@@ -320,6 +54,12 @@ class Commit:
 		self.events  = []
 		self.repo    = repo
 		self.revs    = revs
+		self._parentContext = None
+		self._infoThread    = None
+		self._infoProcess   = None
+		self._index         = None
+		self._completions   = None
+		self._completionsThread = None
 
 	def load( self, path=".hgcommit" ):
 		if os.path.exists(path):
@@ -350,13 +90,37 @@ class Commit:
 		return message
 
 	def changed( self, match=None ):
-		return [_ for _ in self.events if isinstance(_, ChangeEvent) and _.match(match)]
+		return self.find(match, ChangeEvent)
 
 	def removed( self, match=None ):
-		return [_ for _ in self.events if isinstance(_, RemoveEvent) and _.match(match)]
+		return self.find(match, RemoveEvent)
 
 	def added( self, match=None ):
-		return [_ for _ in self.events if isinstance(_, AddEvent) and _.match(match)]
+		return self.find(match, AddEvent)
+
+	def find( self, match=None, kind=None ):
+		"""Returns the events of the given @kind (any by default) whose path
+		is or matches the given glob, in their commit order."""
+		return [self.events[_] for _ in self.index().match(match, kind)]
+
+	def filter( self, expr=None ):
+		"""Returns the positions of the events matching the given filter
+		expression, which is a glob when it contains wildcards, and a path
+		prefix otherwise. All the positions are returned when there is no
+		expression."""
+		if not expr:
+			return range(len(self.events))
+		elif PathIndex.isGlob(expr):
+			return self.index().glob(expr)
+		else:
+			return self.index().prefix(expr)
+
+	def index( self ):
+		"""Returns the 'PathIndex' of the events, which is rebuilt when events
+		were added."""
+		if self._index is None or len(self._index) != len(self.events):
+			self._index = PathIndex(self.events)
+		return self._index
 
 	def empty( self ):
 		return len(self.events) == 0
@@ -364,26 +128,206 @@ class Commit:
 	def commandInRepo( self, command ):
 		"""Executes the given command within the repository, and returns its
 		result."""
-		cwd = os.getcwd()
-		os.chdir(os.path.dirname(self.repo.path))
-		res = os.popen(command).read()
-		os.chdir(cwd)
-		return res
+		return subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+		cwd=self.repo.root).communicate()[0]
 
 	def hg( self, command ):
 		return self.commandInRepo("hg " + command)
 
+	def parentContext( self ):
+		"""Returns the Mercurial context of the (first) working copy parent."""
+		if self._parentContext is None:
+			self._parentContext = self.repo[None].parents()[0]
+		return self._parentContext
+
 	def parent( self ):
 		"""Returns the local parent revision number."""
-		parent = self.hg("parent").split("\n")[0].split(":")[1].strip()
-		return parent
+		return str(self.parentContext().rev())
 
 	def current(self):
 		return self.revs
 
+	def writePartial( self, events ):
+		"""Writes the selected hunks of the given change events in the working
+		copy, so that they can be committed. The working files are moved
+		aside (and not copied), so that each is written only once, and the
+		returned list of '(PATH, BACKUP)' couples is to be given to
+		'restorePartial' after the commit."""
+		backups = []
+		try:
+			for event in events:
+				path = event.abspath()
+				fd, backup = tempfile.mkstemp(prefix="easycommit-", dir=self.repo.path)
+				os.close(fd)
+				os.rename(path, backup)
+				backups.append((path, backup))
+				with open(path, "wb") as f:
+					f.write("".join(event.diff().patched()))
+				shutil.copymode(backup, path)
+		except:
+			self.restorePartial(backups)
+			raise
+		return backups
+
+	def restorePartial( self, backups ):
+		"""Moves back the working files moved aside by 'writePartial'. As
+		their size or modification time differ from the committed ones,
+		Mercurial still sees them as modified."""
+		for path, backup in backups:
+			os.rename(backup, path)
+
+	def computeInfo( self ):
+		"""Computes the diffstat of all the change events in a single 'hg diff'
+		pass, in a background thread. Each event's info is cached as soon as
+		its part of the diff has been read, and 'ChangeEvent.info' never waits
+		for it."""
+		if self._infoThread: return self._infoThread
+		events = dict((_.path, _) for _ in self.changed())
+		self._infoThread = threading.Thread(target=self._computeInfo, args=(events,))
+		self._infoThread.setDaemon(True)
+		self._infoThread.start()
+		return self._infoThread
+
+	def isComputingInfo( self ):
+		"""Tells if the background diffstat computation is still running."""
+		return self._infoThread is not None and self._infoThread.is_alive()
+
+	def stopInfo( self ):
+		"""Stops the background diffstat computation, if it is running."""
+		process = self._infoProcess
+		if process and process.poll() is None:
+			try:
+				process.terminate()
+			except OSError:
+				pass
+
+	def _computeInfo( self, events ):
+		from easyhg.api import parse_diffstat
+		if not events: return
+		# The paths are given through a list file, as there may be too many
+		# of them for the command line.
+		fd, listfile = tempfile.mkstemp(prefix="hg-commit")
+		try:
+			os.write(fd, "\n".join(sorted(events)))
+			os.close(fd)
+			self._infoProcess = subprocess.Popen(
+				["hg", "diff", "--git", "listfile:" + listfile],
+				stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.repo.root
+			)
+			# Lines starting with 'diff ' can only be file headers, so the
+			# diff is parsed one file at a time, as it is read.
+			lines = []
+			for line in iter(self._infoProcess.stdout.readline, ""):
+				if line.startswith("diff ") and lines:
+					self._setInfo(events, parse_diffstat(lines))
+					lines = []
+				lines.append(line[:-1] if line.endswith("\n") else line)
+			if lines:
+				self._setInfo(events, parse_diffstat(lines))
+			self._infoProcess.wait()
+		finally:
+			os.unlink(listfile)
+			for event in events.values():
+				if not event._cache_info: event._cache_info = "Diffstat not available"
+
+	def loadCompletions( self ):
+		"""Loads the completion index of the repository (see
+		'easyhg.completion') in a background thread, as updating it may need
+		to read the history when many changesets were added."""
+		if self._completionsThread: return self._completionsThread
+		self._completionsThread = threading.Thread(target=self._loadCompletions)
+		self._completionsThread.setDaemon(True)
+		self._completionsThread.start()
+		return self._completionsThread
+
+	def completions( self ):
+		"""Returns the completion index, or None while it is loading."""
+		return self._completions
+
+	def _loadCompletions( self ):
+		from easyhg.completion import CompletionIndex
+		try:
+			self._completions = CompletionIndex.load(self.repo.root)
+		except (IOError, OSError):
+			self._completions = None
+
+	def _setInfo( self, events, diffstat ):
+		for _, stats in diffstat:
+			for path, (added, removed) in stats.items():
+				event = events.get(path)
+				if event: event._cache_info = format_diffstat(path, added, removed)
+
 	def __str__( self ):
 		return str(self.events)
 
+class PathIndex:
+	"""Indexes the paths of a list of events, so that exact, prefix and glob
+	queries do not need to scan all the events. The events are bucketed by
+	type, and each bucket is a sorted list of '(PATH, POSITION)' couples where
+	POSITION is the position of the event in the list. Queries return the
+	(sorted) positions of the matching events."""
+
+	WILDCARDS = re.compile("[*?[]")
+
+	@classmethod
+	def isGlob( cls, expr ):
+		return cls.WILDCARDS.search(expr) is not None
+
+	def __init__( self, events ):
+		self.buckets = {None:[]}
+		for i, event in enumerate(events):
+			self.buckets.setdefault(event.__class__, []).append((event.path, i))
+			self.buckets[None].append((event.path, i))
+		for bucket in self.buckets.values(): bucket.sort()
+		self._length = len(events)
+
+	def __len__( self ):
+		return self._length
+
+	def _range( self, prefix, kind=None ):
+		"""Returns the slice of the bucket for the given @kind whose paths
+		start with the given prefix."""
+		bucket = self.buckets.get(kind, ())
+		start  = bisect.bisect_left(bucket, (prefix,))
+		end    = start
+		while end < len(bucket) and bucket[end][0].startswith(prefix): end += 1
+		return bucket[start:end]
+
+	def exact( self, path, kind=None ):
+		return sorted(i for p, i in self._range(path, kind) if p == path)
+
+	def prefix( self, prefix, kind=None ):
+		return sorted(i for _, i in self._range(prefix, kind))
+
+	def glob( self, pattern, kind=None ):
+		# Only the paths starting with the literal part of the pattern can match
+		match = self.WILDCARDS.search(pattern)
+		literal = pattern[:match.start()] if match else pattern
+		return sorted(i for p, i in self._range(literal, kind) if fnmatch(p, pattern))
+
+	def match( self, expr=None, kind=None ):
+		"""Returns the positions of the events of the given @kind whose path
+		is or matches the given glob, like 'Event.match'."""
+		if expr is None:
+			return sorted(i for _, i in self.buckets.get(kind, ()))
+		elif self.isGlob(expr):
+			return sorted(set(self.exact(expr, kind) + self.glob(expr, kind)))
+		else:
+			return self.exact(expr, kind)
+
+def format_diffstat( path, added, removed, width=DIFFSTAT_WIDTH ):
+	"""Formats the given line counts for the given path the way 'diffstat'
+	does, with a histogram that is at most @width characters wide."""
+	total = added + removed
+	if total > width:
+		plus  = int(round(float(added) * width / total))
+		minus = width - plus
+	else:
+		plus, minus = added, removed
+	return " %s | %d %s%s\n 1 file changed, %d insertions(+), %d deletions(-)" % (
+		path, total, "+" * plus, "-" * minus, added, removed
+	)
+
 # ------------------------------------------------------------------------------
 #
 # COMMIT EVENTS
@@ -403,7 +347,8 @@ class Event:
 		self.name   = name
 		self.path   = path
 		self.parent = parent
-		self._cache_info = None
+		self._cache_info   = None
+		self._cache_parent = None
 
 	def parentRevision( self ):
 		return None
@@ -430,13 +375,45 @@ class ChangeEvent( Event ):
 
 	def __init__( self, parent, path ):
 		Event.__init__(self, parent, Event.CHANGE, path)
+		self._diff = None
 
 	def parentRevision( self ):
-		return self.parent.hg("cat -r%s '%s'" % (self.parent.parent(), self.abspath()))
+		if self._cache_parent is None:
+			ctx = self.parent.parentContext()
+			self._cache_parent = ctx[self.path].data() if self.path in ctx else False
+		return self._cache_parent or None
+
+	def diff( self ):
+		"""Returns the 'easyhg.diff.Diff' between the parent revision and the
+		working copy, which holds the hunk selection. None is returned for
+		binary files and symbolic links."""
+		if self._diff is None:
+			path = self.abspath()
+			if os.path.islink(path):
+				self._diff = False
+			else:
+				with open(path, "rb") as f:
+					current = f.read()
+				parent = self.parentRevision() or ""
+				if "\0" in current or "\0" in parent:
+					self._diff = False
+				else:
+					from easyhg.diff import Diff, splitlines
+					self._diff = Diff(splitlines(parent), splitlines(current))
+		return self._diff or None
+
+	def isPartial( self ):
+		"""Tells if only some of the hunks of this change were selected."""
+		return bool(self._diff) and self._diff.isPartial()
+
+	def isEmpty( self ):
+		"""Tells if none of the hunks of this change were selected."""
+		return bool(self._diff) and self._diff.isEmpty()
 
 	def info( self ):
 		"""Returns the diffstat information"""
 		if self._cache_info: return self._cache_info
+		if self.parent.isComputingInfo(): return " Computing diffstat…"
 		info = self.parent.commandInRepo("hg diff '%s' | diffstat" % (self.path))
 		if info and info[-1] == "\n": info = info[:-1]
 		self._cache_info = info or "Diffstat not available"
@@ -461,7 +438,7 @@ class AddEvent( Event ):
 				st_mtime
 			)
 		else:
-			info = " Symbolic link to: " + os.popen("readlink '%s'" % (self.abspath())).read()
+			info = " Symbolic link to: " + os.readlink(self.abspath())
 		self._cache_info = info
 		return self._cache_info
 
@@ -477,12 +454,56 @@ class RemoveEvent( Event ):
 #
 # ------------------------------------------------------------------------------
 
-USERNAME = None
-OPTIONS  = None
+USERNAME        = None
+OPTIONS         = None
+SUBREPO_WORKERS = 8
+
+def subrepositories( root ):
+	"""Returns the paths of the subrepositories declared in the '.hgsub' file
+	of the repository at the given root."""
+	hgsub = os.path.join(root, ".hgsub")
+	subs  = []
+	if os.path.exists(hgsub):
+		with open(hgsub) as f:
+			for sub in f.readlines():
+				if sub.strip().startswith("#"): continue
+				sub = sub.split("=",1)[0].strip()
+				if sub: subs.append(sub)
+	return subs
+
+def subrepositories_state( root, subs, workers=SUBREPO_WORKERS ):
+	"""Yields '(PATH, ID)' couples, where ID is the 'hg id -n' output for the
+	subrepository at PATH, in the order in which they are available. The
+	subrepositories are checked by a bounded pool of @workers threads, which
+	stop picking new subrepositories once the generator is closed."""
+	pending = Queue.Queue()
+	results = Queue.Queue()
+	stopped = threading.Event()
+	for sub in subs: pending.put(sub)
+	def worker():
+		while not stopped.is_set():
+			try:
+				sub = pending.get_nowait()
+			except Queue.Empty:
+				return
+			process = subprocess.Popen(["hg", "id", "-n", "--repository", os.path.join(root, sub)],
+			stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			results.put((sub, process.communicate()[0].split("\n")[0].strip()))
+	for _ in range(min(workers, len(subs))):
+		thread = threading.Thread(target=worker)
+		thread.setDaemon(True)
+		thread.start()
+	try:
+		for _ in subs:
+			yield results.get()
+	finally:
+		stopped.set()
 
 def commit_wrapper(repo, message, user, date, match, **kwargs):
 	"""Replacement for the localrepository commit that intercepts the list of
 	changes. This function takes care of firing the """
+	import mercurial.localrepo, mercurial.match
+	from easyhg.commitui import ConsoleUI
 
 	assert isinstance(repo, mercurial.localrepo.localrepository),\
 	"Easycommit only works with local repositories (for now)"
@@ -496,32 +517,29 @@ def commit_wrapper(repo, message, user, date, match, **kwargs):
 	ignored   = []
 	cleaned   = []
 
-	hgsub = os.path.join(repo.root, ".hgsub")
-	if os.path.exists(hgsub):
-		with open(hgsub) as f:
-			for sub in f.readlines():
-				if sub.strip().startswith("#"): continue
-				sub = sub.split("=",1)[0].strip()
-				if not sub: continue
-				subid = os.popen("hg id -n --repository '{0}'".format(sub)).read().split("\n")[0]
-				if subid.endswith("+"):
-					error("Subrepository has uncommited changed: {0}".format(sub))
-					info("run: hg easycommit --repository {0}".format(sub))
-					return None
-				else:
-					info("Subrepository has not changed: {0}".format(sub))
+	# The subrepositories are checked concurrently, and we stop as soon as
+	# one of them has changes.
+	for sub, subid in subrepositories_state(repo.root, subrepositories(repo.root)):
+		if subid.endswith("+"):
+			error("Subrepository has uncommited changed: {0}".format(sub))
+			info("run: hg easycommit --repository {0}".format(sub))
+			return None
+		else:
+			info("Subrepository has not changed: {0}".format(sub))
 
-	rev = os.popen("hg id -n --repository '{0}'".format(repo.root)).read().split("\n")[0].split(" ")[0]
-	revs = ["tip" if _ == "-1" else _ for _ in rev.split("+") if _.strip]
+	# The working copy parents and status are read from the repository
+	# itself, which is what 'hg id -n' would report. A single status pass
+	# tells both whether the working copy is dirty and what changed.
+	parents = repo[None].parents()
+	revs    = ["tip" if _.rev() == -1 else str(_.rev()) for _ in parents]
+	ch, ad, rm, dt, un, ig, cl = repo.status()[:7]
 
-	if rev[-1] != "+":
+	if len(parents) < 2 and not (ch or ad or rm or dt):
 		return None
 
-	changes = repo.changectx(revs[0])
-	ch, ad, rm, dt, un, ig, cl = changes.status()
 	changed += ch
 	added   += ad
-	deleted += ad
+	deleted += dt
 	removed += rm
 	ignored += ig
 	cleaned += cl
@@ -539,7 +557,14 @@ def commit_wrapper(repo, message, user, date, match, **kwargs):
 	if not res:
 		info("Nothing was commited")
 		return
-	files = map(lambda c:c.path, app.selectedChanges())
+	# Changes where no hunk was selected are left out, and the ones where
+	# only some hunks were selected are committed partially.
+	selected = [_ for _ in app.selectedChanges() if not (isinstance(_, ChangeEvent) and _.isEmpty())]
+	partial  = [_ for _ in selected if isinstance(_, ChangeEvent) and _.isPartial()]
+	files    = map(lambda c:c.path, selected)
+	if not selected and app.selectedChanges():
+		info("Nothing was commited")
+		return
 	# FIXME: We might want to create a new match here
 	# Now we execute the old commit method
 	if files:
@@ -551,17 +576,23 @@ def commit_wrapper(repo, message, user, date, match, **kwargs):
 		kwargs["editor"] = None
 		commit_object.save(**app.commitMessage(json=True))
 	# FIXME: For some reason that does not work for amend
-	return repo._old_commit( message, user, date, match, **kwargs )
+	backups = commit_object.writePartial(partial)
+	try:
+		return repo._old_commit( message, user, date, match, **kwargs )
+	finally:
+		commit_object.restorePartial(backups)
 
 def command_defaults(ui, cmd):
 	"""Returns the default option values for the given Mercurial command. This
 	was taken from the Tailor conversion script."""
+	import mercurial.cmdutil, mercurial.commands
 	defaults = mercurial.cmdutil.findcmd(cmd, mercurial.commands.table)
 	return dict([(f[1].replace('-', '_'), f[2]) for f in defaults[1][1]])
 
 def _commit( ui, repo, *args, **opts ):
 	"""This is the main function that is called by the 'hg' commands (actually
 	through the 'mercurial.commands.dispatch' function)."""
+	import mercurial.commands
 	# Here we swap the default commit implementation with ours
 	commit_message = opts.get("message")
 	global USERNAME ; USERNAME = ui.username()
@@ -586,11 +617,16 @@ def _commit( ui, repo, *args, **opts ):
 		mercurial.commands.commit(ui, repo, *args, **new_opts)
 
 # SEE: https://www.mercurial-scm.org/wiki/WritingExtensions
-cmdtable       = {}
-command        = mercurial.cmdutil.command(cmdtable)
-COMMIT_COMMAND =  mercurial.commands.table["^commit|ci"]
+cmdtable = {}
+
+def uisetup( ui ):
+	"""Registers the 'easycommit' command with the options of 'commit'.
+	Mercurial reads the 'cmdtable' after calling 'uisetup', so the command
+	table does not need to be imported when the extension is loaded."""
+	import mercurial.cmdutil, mercurial.commands
+	command = mercurial.cmdutil.command(cmdtable)
+	command('easycommit', mercurial.commands.table["^commit|ci"][1])(commit)
 
-@command('easycommit', COMMIT_COMMAND[1])
 def commit( *args, **kwargs ):
 	return _commit(*args, **kwargs)
 
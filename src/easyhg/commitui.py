@@ -0,0 +1,534 @@
+#!/usr/bin/env python
+# Encoding: utf8
+# -----------------------------------------------------------------------------
+# Project   : Mercurial - Easycommit
+# License   : GNU Public License         <http://www.gnu.org/licenses/gpl.html>
+# -----------------------------------------------------------------------------
+# Author    : Sébastien Pierre                           <sebastien@type-z.org>
+# -----------------------------------------------------------------------------
+# Creation  : 10-Jul-2006
+# Last mod  : 19-Oct-2026
+# -----------------------------------------------------------------------------
+
+import os, tempfile, array, itertools, collections
+import urwide, urwid
+import easyhg.mergetool as mergetool
+from   easyhg.commit import __version__, ChangeEvent
+from   easyhg.batch  import normalize_message, format_message
+
+__doc__ = """\
+The Easycommit console user interface, which is only imported when the
+'easycommit' command runs (see 'easyhg.commit').
+"""
+
+# ------------------------------------------------------------------------------
+#
+# CONSOLE INTERFACE
+#
+# ------------------------------------------------------------------------------
+DEFAULT_TAGS  = [
+	"Release",
+	"New",
+	"Update",
+	"Change",
+	"Feature",
+	"Refactor",
+	"Fix",
+	"WIP",
+	"Merge",
+	"Submodules",
+]
+
+CHANGES_HEIGHT = 15
+
+CONSOLE_STYLE = """\
+Frame         : WH, DB, SO
+header        : WH, DC, BO
+footer        : WH, DB, SO
+info          : BL, DC, SO
+tooltip       : Lg, DB, BO
+
+label         : Lg, DB, SO
+title         : WH, DB, BO
+
+Edit          : WH, DB, BO
+Edit*         : WH, DM, BO
+Button        : LC, DB, BO
+Button*       : WH, DM, BO
+CheckBox      : Lg, DB, SO
+CheckBox*     : Lg, DM, SO
+Divider       : DC, DB, SO
+Text          : Lg, DB, SO
+Text*         : WH, DM, BO
+
+diff.hunk     : LC, DB, BO
+diff.add      : LG, DB, SO
+diff.del      : LR, DB, SO
+
+#edit_summary : YL, DB, SO
+"""
+
+CONSOLE_UI = """\
+Hdr MERCURIAL - Easycommit %s
+
+Edt Name          [$USERNAME]               #edit_user
+Edt Tags          [Update]                  #edit_tags    ?TAGS    &key=tag
+Edt Scope         [‥]                       #edit_scope   ?SCOPE   &key=scope   &focus=completeScope
+Edt Summary       [‥]                       #edit_summary ?SUMMARY &key=summary &focus=completeSummary
+Dvd ___
+
+Box
+  Edt [‥]                                   #edit_desc    ?DESC &key=describe multiline=True
+End
+
+Dvd ___
+
+Edt Filter        [‥]                       #edit_filter  ?FILTER  &key=sumUp &edit=filter
+Ple                                         #changes
+End
+Dvd ___
+
+GFl
+	Btn [Cancel]                            #btn_cancel  &press=cancel
+	Btn [Commit]                            #btn_commit  &press=commit
+End
+
+	""" % (__version__)
+
+class ConsoleUI:
+	"""Main user interface for commit."""
+
+	def __init__(self):
+		self.ui = urwide.Console()
+		self.defaultHandler = ConsoleUIHandler()
+		self.ui.handler(self.defaultHandler)
+		self.ui.strings.DESC    = "Describe your changes in detail here"
+		self.ui.strings.SUMMARY = "Give a one-line summary of your changes, [Ctrl-N] completes it"
+		self.ui.strings.TAGS    = "Enter tags [+] and [-] to cycle through available tags"
+		self.ui.strings.SCOPE   = "Enter the scope of the the change, [Ctrl-N] completes it"
+		self.ui.strings.FILTER  = "Show only the changes under a directory, or matching a glob"
+		self.ui.strings.CHANGE  = "[V]iew [E]xternal diff [C]ommit [S]ave [Q]uit"
+
+	def main( self, commit = None ):
+		self.ui.create(CONSOLE_STYLE, CONSOLE_UI)
+		message = (commit.load() if commit else {}) or {}
+		self.ui.DEFAULT_SUMMARY     = message.get("summary")     or self.ui.widgets.edit_summary.get_edit_text()
+		self.ui.DEFAULT_DESCRIPTION = message.get("description") or self.ui.widgets.edit_desc.get_edit_text()
+		self.ui.DEFAULT_SCOPE       = message.get("scope")       or self.ui.widgets.edit_scope.get_edit_text()
+		if commit and len(commit.revs) > 1:
+			self.ui.DEFAULT_TAGS = "[Merge]"
+		self.ui.data.commit = commit
+		if commit:
+			if commit.changed(".hgsub*") or commit.added(".hgsub*") or commit.empty():
+				self.ui.widgets.edit_tags.set_edit_text("Submodules")
+			self.defaultHandler.updateCommitFiles()
+			commit.computeInfo()
+			commit.loadCompletions()
+		try:
+			return self.ui.main()
+		finally:
+			if commit: commit.stopInfo()
+
+	def selectedChanges(self):
+		return self.defaultHandler.selectedChanges()
+
+	def commitMessage( self, json=False ):
+		summ  = self.ui.widgets.edit_summary.get_edit_text()
+		scope = self.ui.widgets.edit_scope.get_edit_text()
+		tags  = self.ui.widgets.edit_tags.get_edit_text()
+		desc  = self.ui.widgets.edit_desc.get_edit_text()
+		# The same rules are used by the batch mode (see 'easyhg.batch')
+		message = normalize_message(summ, scope, tags, desc)
+		if json:
+			return message
+		else:
+			return format_message(**message)
+
+	def commitUser( self ):
+		return self.ui.widgets.edit_user.get_edit_text()
+
+class ConsoleUIHandler(urwide.Handler):
+	"""Main event handler."""
+
+	def onSave( self, button ):
+		self.ui.tooltip("Save")
+
+	def onCancel( self, button ):
+		self.ui.tooltip("Cancel")
+		self.ui.end("Commit canceled",status=False)
+
+	def onCommit( self, button ):
+		self.ui.tooltip("Commit")
+		self.ui.end()
+
+	def onSumUp( self, widget, key ):
+		if hasattr(widget, "_alreadyEdited"): return False
+		if key in ("left", "right", "up", "down", "tab", "shift tab"): return False
+		widget.set_edit_text("" + (key if len(key) == 1 else ""))
+		widget._alreadyEdited = True
+
+	def onSummary( self, widget, key ):
+		if key == "ctrl n": return self.complete(widget, "summaries")
+		return self.onSumUp(widget, key)
+
+	def onScope( self, widget, key ):
+		if key == "ctrl n": return self.complete(widget, "scopes")
+		return self.onSumUp(widget, key)
+
+	def onDescribe( self, widget, key ):
+		return self.onSumUp(widget, key)
+
+	def onCompleteScope( self, widget ):
+		self.showCompletions(widget, "scopes")
+
+	def onCompleteSummary( self, widget ):
+		self.showCompletions(widget, "summaries")
+
+	def availableTags( self ):
+		"""Returns the tags that are cycled through, the ones most used in the
+		history of the repository coming first, followed by the remaining
+		@DEFAULT_TAGS."""
+		tags = self.completions("tags", "")
+		return tags + [_ for _ in DEFAULT_TAGS if _ not in tags]
+
+	def isTag( self, tagname, tags=None ):
+		"""Tells wether the given @tagname (as text) is one of the given tags
+		(the 'availableTags' by default) and returns the indice of the tag in
+		the array. The tag matches if on of the tags start with the given
+		tagname."""
+		tags = tags or self.availableTags()
+		i = 0
+		for tag in tags:
+			if tagname.lower() == tag.lower():
+				return i
+			i += 1
+		i = 0
+		for tag in tags:
+			if tag.lower().startswith(tagname.lower()):
+				if i == 0: return len(tags) - 1
+				else: return i- 1
+			i += 1
+		return -1
+
+	def onTag( self, widget, key ):
+		# This takes into account tag completion
+		if key in ( "+", "-" ):
+			if key == "+":
+				offset  = 1
+				default = -1
+			else:
+				offset  = -1
+				default = 0
+			available = self.availableTags()
+			o = widget.edit_pos
+			t = widget.get_edit_text()
+			current_tag = len(map(lambda x:x.strip(), t[:o].strip().split())) -1
+			tags = map(lambda x:x.strip(), t.strip().split())
+			if tags:
+				i = self.isTag(tags[current_tag], available)
+				i = (i+ offset) % len(available)
+				tooltip = "Available tags: %s [%s] %s" % (
+					" ".join(available[:i]),
+					available[i].upper(),
+					" ".join(available[i+1:])
+				)
+				self.ui.tooltip(tooltip)
+				tags[current_tag] = (available[i])
+			else:
+				tags.append(available[default])
+			widget.set_edit_text(" ".join(tags))
+			widget._alreadyEdited = True
+			return True
+		if not hasattr(widget, "_alreadyEdited"):
+			if key in ("left", "right", "up", "down", "tab", "shift tab"): return False
+			widget.set_edit_text("")
+			widget._alreadyEdited = True
+			return False
+		else:
+			return False
+
+	def onFilter( self, widget, before, after ):
+		if before == after: return
+		if after.startswith("‥"): after = ""
+		self.changesWalker.filter(self.ui.data.commit.filter(after.strip()))
+
+	def onChangeInfo( self, widget ):
+		self.ui.tooltip(widget.commitEvent.info())
+		self.ui.info(self.ui.strings.CHANGE)
+
+	def onChange( self, widget, key ):
+		if key == "v":
+			self.viewFile(widget.commitEvent)
+		elif key == "e":
+			self.reviewFile(widget.commitEvent)
+		else:
+			return False
+
+	def onKeyPress( self, widget, key ):
+		if key in ("q", "esc"):
+			self.onCancel(widget)
+		elif key == "s":
+			self.onSave(widget)
+		elif key == "c":
+			self.onCommit(widget)
+		else:
+			return False
+
+	# SPECIFIC ACTIONS
+	# _________________________________________________________________________
+
+	def updateCommitFiles(self):
+		commit = self.ui.data.commit
+		# Cleans up the existing widgets
+		changes = self.ui.unwrap(self.ui.widgets.changes)
+		changes.remove_widgets()
+		# The checkboxes are only created for the rows that are displayed
+		self.changesWalker = ChangesWalker(commit.events, self.createChange)
+		if commit.events:
+			# When only the .hgsubstate has changed, we might have 0 events
+			height = min(len(commit.events), CHANGES_HEIGHT)
+			changes.add_widget(urwid.BoxAdapter(urwid.ListBox(self.changesWalker), height))
+			changes.set_focus(0)
+
+	def completions( self, kind, prefix ):
+		"""Returns the completions of the given kind ('tags', 'scopes' or
+		'summaries') for the given prefix, which are empty while the
+		completion index is loading."""
+		commit = self.ui.data.commit
+		index  = commit.completions() if commit else None
+		if not index: return []
+		return getattr(index, kind).complete(prefix)
+
+	def showCompletions( self, widget, kind ):
+		"""Shows the completions of the given widget's text as a tooltip."""
+		text  = widget.get_edit_text() if hasattr(widget, "_alreadyEdited") else ""
+		words = [_ for _ in self.completions(kind, text) if _ != text]
+		if words:
+			self.ui.tooltip("Completions: " + " | ".join(words))
+
+	def complete( self, widget, kind ):
+		"""Replaces the text of the given widget by the next completion of
+		the text that was typed before completing, so that repeating the
+		completion cycles through them."""
+		text = widget.get_edit_text() if hasattr(widget, "_alreadyEdited") else ""
+		if getattr(widget, "_completion", None) != text:
+			widget._completionPrefix = text
+			widget._completionIndex  = -1
+		words = self.completions(kind, widget._completionPrefix)
+		if not words: return True
+		widget._completionIndex = (widget._completionIndex + 1) % len(words)
+		widget._completion      = words[widget._completionIndex]
+		widget._alreadyEdited   = True
+		widget.set_edit_text(widget._completion)
+		widget.set_edit_pos(len(widget._completion))
+		return True
+
+	def createChange( self, walker, index ):
+		"""Creates the checkbox for the event at the given index of the
+		given 'ChangesWalker'."""
+		event    = walker.events[index]
+		checkbox = self.ui.new(urwid.CheckBox, "%-10s %s" %(event.name, event.path), bool(walker.selected[index]))
+		self.ui.unwrap(checkbox).commitEvent     = event
+		self.ui.unwrap(checkbox).on_state_change = lambda w, state: walker.select(index, state)
+		checkbox = self.ui.wrap(checkbox, "?CHANGE &focus=changeInfo")
+		self.ui.onFocus(checkbox, "changeInfo")
+		self.ui.onKey(checkbox, "change")
+		return checkbox
+
+	def viewFile( self, commitEvent ):
+		"""Shows the differences for the given event in the built-in diff
+		pane."""
+		if not isinstance(commitEvent, ChangeEvent):
+			self.ui.tooltip("No differences to view for " + commitEvent.path)
+			return
+		diff = commitEvent.diff()
+		if diff is None:
+			self.ui.tooltip("Binary file, no differences to view: " + commitEvent.path)
+			return
+		self.ui.dialog(DiffPane(self.ui, commitEvent.path, diff))
+
+	def reviewFile( self, commitEvent ):
+		parent_rev = commitEvent.parentRevision()
+		fd, path   = tempfile.mkstemp(prefix="hg-commit")
+		if not parent_rev: parent_rev = ""
+		os.write(fd, parent_rev)
+		self.ui.tooltip("Reviewing differences for " + commitEvent.path)
+		self.ui.draw()
+		mergetool.review(commitEvent.abspath(), path)
+		os.close(fd)
+		os.unlink(path)
+
+	def selectedChanges( self ):
+		"""Returns the list of selected change events."""
+		return self.changesWalker.selectedEvents()
+
+class ChangesWalker(urwid.ListWalker):
+	"""Walks the events of a commit, only creating the widgets of the rows that
+	are actually displayed. The selection state of all the events is kept in
+	a compact array, so that huge commits open and redraw quickly. The rows
+	can be narrowed to a subset of the events with 'filter'."""
+
+	CACHE_SIZE = 256
+
+	def __init__( self, events, create ):
+		"""The @create callback is invoked as 'create(walker, index)' to
+		create the widget for the event at the given index."""
+		self.events    = events
+		self.selected  = array.array("B", [1]) * len(events)
+		self.positions = None
+		self.focus     = 0
+		self._create   = create
+		self._widgets  = collections.OrderedDict()
+
+	def filter( self, positions=None ):
+		"""Only shows the events at the given positions, or all the events
+		when @positions is None."""
+		self.positions = positions
+		self.focus     = 0
+		self._modified()
+
+	def index( self, row ):
+		"""Returns the index of the event displayed at the given row, or None."""
+		if self.positions is None:
+			return row if 0 <= row < len(self.events) else None
+		else:
+			return self.positions[row] if 0 <= row < len(self.positions) else None
+
+	def widget( self, row ):
+		"""Returns the widget for the given row, creating it if it is not
+		among the recently displayed ones."""
+		index = self.index(row)
+		if index is None: return None
+		widget = self._widgets.pop(index, None)
+		if widget is None: widget = self._create(self, index)
+		self._widgets[index] = widget
+		while len(self._widgets) > self.CACHE_SIZE:
+			self._widgets.popitem(last=False)
+		return widget
+
+	def select( self, index, state=True ):
+		self.selected[index] = 1 if state else 0
+
+	def selectedEvents( self ):
+		"""Returns the list of selected events, whether they are shown or
+		not."""
+		return list(itertools.compress(self.events, self.selected))
+
+	def get_focus( self ):
+		widget = self.widget(self.focus)
+		return (widget, self.focus) if widget else (None, None)
+
+	def set_focus( self, position ):
+		self.focus = position
+		self._modified()
+
+	def get_next( self, start_from ):
+		widget = self.widget(start_from + 1)
+		return (widget, start_from + 1) if widget else (None, None)
+
+	def get_prev( self, start_from ):
+		widget = self.widget(start_from - 1)
+		return (widget, start_from - 1) if widget else (None, None)
+
+class DiffWalker(urwid.ListWalker):
+	"""Walks the rows of an 'easyhg.diff.Diff', grouping its hunks and
+	creating the text widgets only for the rows that are displayed."""
+
+	CACHE_SIZE = 512
+	PREFIX     = {"=":" ", "+":"+", "-":"-"}
+	STYLE      = {"@":"diff.hunk", "=":"Text", "+":"diff.add", "-":"diff.del"}
+
+	def __init__( self, diff ):
+		self.diff     = diff
+		self.focus    = 0
+		self._widgets = collections.OrderedDict()
+
+	def widget( self, row ):
+		"""Returns the widget for the given row, or None if the row is
+		outside of the diff."""
+		if row < 0: return None
+		widget = self._widgets.pop(row, None)
+		if widget is None:
+			line = self.diff.row(row)
+			if line is None: return None
+			tag, text = line
+			if tag == "@":
+				prefix = "[x] " if self.diff.isSelected(self.diff.hunkAt(row)) else "[ ] "
+			else:
+				prefix = self.PREFIX[tag]
+			text   = prefix + text.rstrip("\r\n").expandtabs(4)
+			widget = urwid.AttrWrap(urwid.Text(text, wrap="clip"), self.STYLE[tag])
+		self._widgets[row] = widget
+		while len(self._widgets) > self.CACHE_SIZE:
+			self._widgets.popitem(last=False)
+		return widget
+
+	def refresh( self, row ):
+		"""Recreates the widget for the given row."""
+		self._widgets.pop(row, None)
+		self._modified()
+
+	def get_focus( self ):
+		widget = self.widget(self.focus)
+		return (widget, self.focus) if widget else (None, None)
+
+	def set_focus( self, position ):
+		self.focus = position
+		self._modified()
+
+	def get_next( self, start_from ):
+		widget = self.widget(start_from + 1)
+		return (widget, start_from + 1) if widget else (None, None)
+
+	def get_prev( self, start_from ):
+		widget = self.widget(start_from - 1)
+		return (widget, start_from - 1) if widget else (None, None)
+
+class DiffPane:
+	"""A full screen pane that shows a diff, displayed as a dialog of the
+	console. Only the visible rows are rendered, and hunks are grouped as the
+	user scrolls, so that huge files and diffs open instantly."""
+
+	HELP = "[Space] Select hunk  [N]ext hunk  [P]revious hunk  [Q]uit"
+
+	def __init__( self, ui, path, diff ):
+		self.ui      = ui
+		self.diff    = diff
+		self.walker  = DiffWalker(diff)
+		self.listbox = urwid.ListBox(self.walker)
+		header       = urwid.AttrWrap(urwid.Text(" %s    %s" % (path, self.HELP), wrap="clip"), "header")
+		self._view   = urwid.Frame(self.listbox, header=header)
+		self._view._urwideOnKey = self.onKey
+		if not diff.rows(1):
+			self.ui.tooltip("No differences for " + path)
+
+	def width( self ):
+		return self.ui.getCurrentSize()[0]
+
+	def height( self ):
+		return self.ui.getCurrentSize()[1]
+
+	def view( self ):
+		return self._view
+
+	def onKey( self, widget, key ):
+		if key in ("q", "esc"):
+			self.ui.dialog(None)
+		elif key in ("n", "p"):
+			focus = self.walker.focus
+			hunk  = self.diff.hunkAt(focus)
+			if hunk is None: hunk = self.diff.hunks()
+			hunk += 1 if key == "n" else -1
+			if 0 <= hunk < self.diff.hunks(hunk + 1):
+				self.listbox.set_focus(self.diff.offsets[hunk])
+				self.listbox.set_focus_valign("top")
+		elif key in (" ", "enter"):
+			hunk = self.diff.hunkAt(self.walker.focus)
+			if hunk is not None:
+				self.diff.select(hunk, not self.diff.isSelected(hunk))
+				self.walker.refresh(self.diff.offsets[hunk])
+		else:
+			self._view.keypress((self.width(), self.height()), key)
+		return True
+
+# EOF - vim: tw=80 ts=4 sw=4 noet
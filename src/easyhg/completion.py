@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# Encoding: utf8
+# -----------------------------------------------------------------------------
+# Project   : Mercurial - Easycommit
+# License   : GNU Public License         <http://www.gnu.org/licenses/gpl.html>
+# -----------------------------------------------------------------------------
+# Author    : Sébastien Pierre                           <sebastien@type-z.org>
+# -----------------------------------------------------------------------------
+# Creation  : 19-Oct-2026
+# Last mod  : 19-Oct-2026
+# -----------------------------------------------------------------------------
+
+import os, re, subprocess, cPickle
+
+__doc__ = """\
+Completion of the tags, scopes and summaries of commit messages, based on the
+'[Tag][Tag] scope: summary' messages found in the history of the repository.
+The index is updated incrementally from the changelog, and persisted in the
+'.hg' directory, so that the history is read only once.
+"""
+
+COMPLETION_CACHE = "easyhg-completion"
+COMPLETION_SIZE  = 8
+SUMMARY_WORDS    = 3
+RE_MESSAGE       = re.compile(r"^\s*((?:\[[^\]]+\]\s*)*)(?:([^\s:\[][^:]{0,40}):\s+)?(.*)$")
+RE_TAG           = re.compile(r"\[([^\]]+)\]")
+
+def parse_message( message ):
+	"""Returns the '(TAGS, SCOPE, SUMMARY)' of the first line of the given
+	commit message, where SCOPE is None when there is none."""
+	line  = (message or "").split("\n", 1)[0]
+	match = RE_MESSAGE.match(line)
+	tags  = [_.strip() for _ in RE_TAG.findall(match.group(1)) if _.strip()]
+	return tags, (match.group(2) or "").strip() or None, match.group(3).strip()
+
+# ------------------------------------------------------------------------------
+#
+# PREFIX TRIE
+#
+# ------------------------------------------------------------------------------
+
+class PrefixTrie:
+	"""A trie of words where each node keeps the @size most frequent words
+	that start with its prefix, so that completing a prefix only walks the
+	prefix. As counts only grow, the ranked lists stay exact when words are
+	added incrementally."""
+
+	RANKED = None
+
+	def __init__( self, size=COMPLETION_SIZE ):
+		self.size   = size
+		self.counts = {}
+		self.root   = {self.RANKED:[]}
+
+	def add( self, word, count=1 ):
+		"""Adds the given word, or increases its count."""
+		if not word: return
+		count = self.counts.get(word, 0) + count
+		self.counts[word] = count
+		node = self.root
+		self._rank(node, word, count)
+		for c in word:
+			child = node.get(c)
+			if child is None:
+				child = node[c] = {self.RANKED:[]}
+			node = child
+			self._rank(node, word, count)
+
+	def _rank( self, node, word, count ):
+		# Ranked lists are sorted by decreasing count, then by word
+		ranked = node[self.RANKED]
+		entry  = (-count, word)
+		for i, (_, w) in enumerate(ranked):
+			if w == word:
+				del ranked[i]
+				break
+		else:
+			if len(ranked) >= self.size and ranked[-1] < entry: return
+		i = len(ranked)
+		while i > 0 and ranked[i - 1] > entry: i -= 1
+		ranked.insert(i, entry)
+		del ranked[self.size:]
+
+	def complete( self, prefix="", size=None ):
+		"""Returns the most frequent words starting with the given prefix."""
+		node = self.root
+		for c in prefix:
+			node = node.get(c)
+			if node is None: return []
+		return [w for _, w in node[self.RANKED][:size or self.size]]
+
+	def __len__( self ):
+		return len(self.counts)
+
+# ------------------------------------------------------------------------------
+#
+# COMPLETION INDEX
+#
+# ------------------------------------------------------------------------------
+
+class CompletionIndex:
+	"""Indexes the tags, scopes and summary beginnings (up to SUMMARY_WORDS
+	words) of the messages of a repository."""
+
+	def __init__( self ):
+		self.tags      = PrefixTrie()
+		self.scopes    = PrefixTrie()
+		self.summaries = PrefixTrie()
+		self.rev       = -1
+		self.node      = None
+
+	def add( self, message ):
+		"""Adds the given commit message to the index."""
+		tags, scope, summary = parse_message(message)
+		for tag in tags: self.tags.add(tag)
+		if scope: self.scopes.add(scope)
+		words = summary.split()
+		for i in range(1, min(len(words), SUMMARY_WORDS) + 1):
+			self.summaries.add(" ".join(words[:i]))
+
+	def update( self, root ):
+		"""Indexes the changesets of the repository at the given root that
+		were added since the last update, returning the number of indexed
+		changesets. The index is reset when the last indexed changeset is gone
+		(after a strip or a rollback)."""
+		start = max(self.rev, 0)
+		out   = subprocess.Popen(["hg", "log", "--rev", "%d:tip" % (start),
+			"--template", "{rev}\\0{node}\\0{desc|firstline}\\0"],
+			stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=root).communicate()[0]
+		fields  = out.split("\0")
+		entries = [fields[i:i + 3] for i in range(0, len(fields) - 2, 3)]
+		if self.rev >= 0:
+			if not entries or entries[0][1] != self.node:
+				self.__init__()
+				return self.update(root)
+			entries = entries[1:]
+		for rev, node, message in entries:
+			self.add(message)
+			self.rev, self.node = int(rev), node
+		return len(entries)
+
+	@classmethod
+	def load( cls, root ):
+		"""Loads the persisted index of the repository at the given root,
+		updates it and saves it when changesets were added."""
+		path  = os.path.join(root, ".hg", COMPLETION_CACHE)
+		index = None
+		if os.path.exists(path):
+			try:
+				with open(path, "rb") as f:
+					index = cPickle.load(f)
+			except Exception:
+				index = None
+		if not isinstance(index, cls): index = cls()
+		if index.update(root): index.save(root)
+		return index
+
+	def save( self, root ):
+		path = os.path.join(root, ".hg", COMPLETION_CACHE)
+		tmp  = path + ".tmp"
+		with open(tmp, "wb") as f:
+			cPickle.dump(self, f, 2)
+		os.rename(tmp, path)
+
+# EOF - vim: tw=80 ts=4 sw=4 noet
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# Encoding: utf8
+# -----------------------------------------------------------------------------
+# Project   : Mercurial - Easy tools
+# License   : GNU Public License         <http://www.gnu.org/licenses/gpl.html>
+# -----------------------------------------------------------------------------
+# Author    : Sebastien Pierre                           <sebastien@type-z.org>
+# -----------------------------------------------------------------------------
+# Creation  : 19-Oct-2026
+# Last mod  : 19-Oct-2026
+# -----------------------------------------------------------------------------
+
+import os, sys, time, socket, threading
+import easyhg.api as api
+from easyhg.output import *
+
+__version__  = "0.9.4"
+PROGRAM_NAME = "easyhg-daemon"
+__doc__      = """\
+The daemon keeps a repository open in a long-lived process, so that the
+changes, tags and status caches of the EasyAPI and its Mercurial shell are
+shared by all the clients. Clients are 'easyhg.api.Repository' instances, which
+automatically use the daemon when its socket exists in the repository '.hg'
+directory, and fall back to direct mode otherwise.
+
+The daemon shuts itself down after being idle for a while.
+"""
+
+USAGE = """\
+%s %s
+
+Commands :
+
+    start  [DIRECTORY] [--idle=SECONDS] [--detach] - serves the repository
+    stop   [DIRECTORY]                             - stops the daemon
+    status [DIRECTORY]                             - tells if a daemon runs
+""" % (PROGRAM_NAME, __version__)
+
+IDLE_TIMEOUT = 600
+POLL_TIMEOUT = 1.0
+SHUTDOWN     = "shutdown"
+
+# ------------------------------------------------------------------------------
+#
+# DAEMON
+#
+# ------------------------------------------------------------------------------
+
+class Daemon:
+	"""Serves the 'MercurialAPI' methods of the repository at the given path
+	over a Unix socket. Requests are '(METHOD, ARGS, KWARGS)' frames (see
+	'easyhg.api.send_frame') answered by '(SUCCESS, VALUE)' frames."""
+
+	class AlreadyRunning(Exception): pass
+
+	def __init__( self, path=".", idle=IDLE_TIMEOUT ):
+		self.repo       = api.Repository(path, daemon=False)
+		self.path       = api.daemon_socket(self.repo.path())
+		self.idle       = idle
+		self.isRunning  = False
+		self._socket    = None
+		self._clients   = []
+		self._lock      = threading.Lock()
+		self._lastUsed  = time.time()
+		self._signature = None
+
+	def start( self ):
+		"""Binds the socket, making the daemon visible to clients."""
+		if os.path.exists(self.path):
+			if isRunning(self.repo.path()):
+				raise self.AlreadyRunning(self.path)
+			# The socket was left behind by a daemon that died
+			os.unlink(self.path)
+		self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		umask = os.umask(0177)
+		try:
+			self._socket.bind(self.path)
+		finally:
+			os.umask(umask)
+		self._socket.listen(5)
+		self._socket.settimeout(POLL_TIMEOUT)
+		self.isRunning = True
+		return self
+
+	def serve( self ):
+		"""Accepts clients until the daemon is stopped or idle for longer
+		than its idle timeout."""
+		if not self.isRunning: self.start()
+		try:
+			while self.isRunning and time.time() - self._lastUsed < self.idle:
+				try:
+					client, _ = self._socket.accept()
+				except socket.timeout:
+					continue
+				thread = threading.Thread(target=self.handle, args=(client,))
+				thread.setDaemon(True)
+				thread.start()
+		finally:
+			self.stop()
+
+	def stop( self ):
+		"""Stops the daemon and removes its socket. Connected clients are
+		disconnected, so that they fall back to direct mode."""
+		self.isRunning = False
+		if self._socket:
+			self._socket.close()
+			self._socket = None
+			if os.path.exists(self.path): os.unlink(self.path)
+		for client in self._clients[:]:
+			try:
+				client.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+
+	def handle( self, client ):
+		"""Answers the requests of the given client until it disconnects."""
+		client.settimeout(self.idle)
+		self._clients.append(client)
+		try:
+			while self.isRunning:
+				request = api.recv_frame(client)
+				if request is None: break
+				method, args, kwargs = request
+				if method == SHUTDOWN:
+					self.isRunning = False
+					api.send_frame(client, (True, None))
+					break
+				api.send_frame(client, self.dispatch(method, args, kwargs))
+		except socket.error:
+			pass
+		finally:
+			self._clients.remove(client)
+			client.close()
+
+	def dispatch( self, method, args, kwargs ):
+		"""Invokes the given API method and returns a '(SUCCESS, VALUE)'
+		couple, where the value is the error message on failure."""
+		if method not in api.MercurialDaemon.METHODS:
+			return (False, "Unsupported method: %s" % (method))
+		# The API uses a single shell, so requests are processed one at a time
+		with self._lock:
+			self._lastUsed = time.time()
+			self.refresh()
+			try:
+				return (True, getattr(self.repo.api, method)(*args, **kwargs))
+			except Exception as e:
+				return (False, "%s: %s" % (e.__class__.__name__, e))
+
+	def refresh( self ):
+		"""Drops the cached status and tags whenever the working copy or the
+		changelog were modified. The changes are refreshed incrementally by
+		the API itself, based on the tip."""
+		signature = []
+		hg_path   = os.path.join(self.repo.path(), ".hg")
+		for name in ("dirstate", "store/00changelog.i", "00changelog.i", "localtags"):
+			path = os.path.join(hg_path, name)
+			if os.path.exists(path):
+				st = os.stat(path)
+				signature.append((name, st.st_mtime, st.st_size))
+		if signature != self._signature:
+			self.repo.api._modifications = None
+			self.repo.api._tags          = None
+			self._signature = signature
+
+# ------------------------------------------------------------------------------
+#
+# CLIENT FUNCTIONS
+#
+# ------------------------------------------------------------------------------
+
+def isRunning( path="." ):
+	"""Tells if a daemon is serving the repository at the given path."""
+	sock = api.daemon_connect(path)
+	if sock: sock.close()
+	return sock is not None
+
+def shutdown( path="." ):
+	"""Asks the daemon serving the repository at the given path to stop,
+	returning False if there was no daemon."""
+	sock = api.daemon_connect(path)
+	if not sock: return False
+	try:
+		api.send_frame(sock, (SHUTDOWN, (), {}))
+		api.recv_frame(sock)
+	finally:
+		sock.close()
+	return True
+
+def detach():
+	"""Detaches the current process from the terminal, returning True in the
+	detached process and False in the original one."""
+	if os.fork() != 0: return False
+	os.setsid()
+	if os.fork() != 0: os._exit(0)
+	null = os.open(os.devnull, os.O_RDWR)
+	for fd in (0, 1, 2): os.dup2(null, fd)
+	return True
+
+# -----------------------------------------------------------------------------
+#
+# MAIN
+#
+# -----------------------------------------------------------------------------
+
+def run(args):
+	"""Runs the command with the given arguments."""
+	options = [_ for _ in args if _.startswith("--")]
+	args    = [_ for _ in args if not _.startswith("--")]
+	if not args or len(args) > 2:
+		print (USAGE)
+		return -1
+	command = args[0]
+	root    = api.Repository.locate(args[1] if len(args) == 2 else ".")
+	if not root:
+		error("No Mercurial repository found")
+		return -1
+	# Command: start [DIRECTORY]
+	if command == "start":
+		idle = IDLE_TIMEOUT
+		for option in options:
+			if option.startswith("--idle="): idle = int(option.split("=",1)[1])
+		if isRunning(root):
+			warning("A daemon is already serving {0}".format(root))
+			return -1
+		info("Serving {0}, shutting down after {1}s idle".format(root, idle))
+		if "--detach" in options and not detach():
+			return 0
+		Daemon(root, idle).serve()
+		return 0
+	# Command: stop [DIRECTORY]
+	elif command == "stop":
+		if shutdown(root):
+			info("Daemon stopped")
+		else:
+			info("No daemon serving {0}".format(root))
+		return 0
+	# Command: status [DIRECTORY]
+	elif command == "status":
+		if isRunning(root):
+			info("Daemon serving {0}".format(root))
+			return 0
+		else:
+			info("No daemon serving {0}".format(root))
+			return 1
+	else:
+		print (USAGE)
+		return -1
+
+if __name__ == "__main__":
+	sys.exit(run(sys.argv[1:]))
+
+# EOF - vim: tw=80 ts=4 sw=4 noet
@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+# Encoding: utf8
+# -----------------------------------------------------------------------------
+# Project   : Mercurial - Easy tools
+# License   : GNU Public License         <http://www.gnu.org/licenses/gpl.html>
+# -----------------------------------------------------------------------------
+# Author    : Sebastien Pierre                           <sebastien@type-z.org>
+# -----------------------------------------------------------------------------
+# Creation  : 19-Oct-2026
+# Last mod  : 19-Oct-2026
+# -----------------------------------------------------------------------------
+
+import array, bisect
+
+__doc__ = """\
+Line-based diffs whose hunks are computed lazily, as they are needed. The
+matching blocks come from Mercurial's C 'bdiff' module when it is available,
+or from a patience diff otherwise (with a linear-space Myers diff between the
+patience anchors), and the hunks are grouped from them one at a time, so that
+displaying the first hunks of a huge diff does not require to group the whole
+diff.
+
+Lines can be interned as integers (see 'Interner' and 'read_interned'), so
+that files are compared without keeping their lines twice and comparing
+lines is comparing integers. The 'similarity' and 'diffstat' functions work
+on both lines and interned lines.
+
+The 'merge3' function does a three-way merge (like 'diff3') of lists of
+lines from the same matching blocks.
+"""
+
+CONTEXT = 3
+# The Myers diff gives up (considering the ranges as replaced) after this
+# number of differences
+MYERS_LIMIT = 1000
+EQUAL   = "="
+INSERT  = "+"
+DELETE  = "-"
+REPLACE = "!"
+MARKERS = ("<<<<<<< %s\n", "=======\n", ">>>>>>> %s\n")
+
+try:
+	from mercurial.mdiff import bdiff
+	_blocks = bdiff.blocks
+except (ImportError, AttributeError):
+	_blocks = None
+
+# ------------------------------------------------------------------------------
+#
+# FUNCTIONS
+#
+# ------------------------------------------------------------------------------
+
+def splitlines( text ):
+	"""Splits the given text in lines, keeping their end of line. Only '\\n'
+	ends a line, as for Mercurial."""
+	if not text: return []
+	lines = [_ + "\n" for _ in text.split("\n")]
+	lines[-1] = lines[-1][:-1]
+	if not lines[-1]: lines.pop()
+	return lines
+
+def matching_blocks( a, b ):
+	"""Returns the '(A1, A2, B1, B2)' ranges of lines that are the same in the
+	given lists of lines (or arrays of interned lines), the last one being the
+	empty range at the end of both lists."""
+	if _blocks and not isinstance(a, array.array):
+		blocks = list(_blocks("".join(a), "".join(b)))
+	else:
+		blocks = []
+		_patience(a, b, 0, len(a), 0, len(b), blocks)
+	# Contiguous blocks are merged, so that equal runs are never split
+	merged = []
+	for block in blocks:
+		if block[0] == block[1]: continue
+		if merged and merged[-1][1] == block[0] and merged[-1][3] == block[2]:
+			merged[-1] = (merged[-1][0], block[1], merged[-1][2], block[3])
+		else:
+			merged.append(block)
+	merged.append((len(a), len(a), len(b), len(b)))
+	return merged
+
+def _patience( a, b, alo, ahi, blo, bhi, blocks ):
+	"""Appends to @blocks the matching blocks of 'a[alo:ahi]' and
+	'b[blo:bhi]', anchoring the diff on the lines that are unique in both
+	ranges (the patience diff), which is much faster than 'difflib' on large
+	files."""
+	# Common prefix and suffix
+	i, j = alo, blo
+	while i < ahi and j < bhi and a[i] == b[j]: i += 1 ; j += 1
+	if i > alo: blocks.append((alo, i, blo, j))
+	alo, blo = i, j
+	i, j = ahi, bhi
+	while i > alo and j > blo and a[i - 1] == b[j - 1]: i -= 1 ; j -= 1
+	suffix = (i, ahi, j, bhi) if i < ahi else None
+	ahi, bhi = i, j
+	if alo < ahi and blo < bhi:
+		anchors = _anchors(a, b, alo, ahi, blo, bhi)
+		if anchors:
+			for i, j in anchors:
+				_patience(a, b, alo, i, blo, j, blocks)
+				blocks.append((i, i + 1, j, j + 1))
+				alo, blo = i + 1, j + 1
+			_patience(a, b, alo, ahi, blo, bhi, blocks)
+		else:
+			_myers(a, b, alo, ahi, blo, bhi, blocks)
+	if suffix: blocks.append(suffix)
+
+def _anchors( a, b, alo, ahi, blo, bhi ):
+	"""Returns the longest increasing sequence of '(I, J)' positions of the
+	lines that appear exactly once in both ranges."""
+	counts = {}
+	for i in xrange(alo, ahi):
+		line = a[i]
+		counts[line] = (counts[line][0] + 1, i) if line in counts else (1, i)
+	unique = {}
+	for j in xrange(blo, bhi):
+		line  = b[j]
+		count = counts.get(line)
+		if count and count[0] == 1:
+			unique[line] = None if line in unique else (count[1], j)
+	pairs = sorted(_ for _ in unique.values() if _)
+	# Patience sorting on the B positions
+	tails, links, ends = [], {}, []
+	for i, j in pairs:
+		k = bisect.bisect_left(tails, j)
+		links[(i, j)] = ends[k - 1] if k else None
+		if k == len(tails):
+			tails.append(j) ; ends.append((i, j))
+		else:
+			tails[k] = j ; ends[k] = (i, j)
+	result = []
+	pair   = ends[-1] if ends else None
+	while pair:
+		result.append(pair)
+		pair = links[pair]
+	result.reverse()
+	return result
+
+def _myers( a, b, alo, ahi, blo, bhi, blocks ):
+	"""Appends to @blocks the matching blocks of 'a[alo:ahi]' and
+	'b[blo:bhi]' using Myers' diff, splitting the ranges on the middle of
+	the shortest edit path so that it runs in linear space."""
+	i, j = alo, blo
+	while i < ahi and j < bhi and a[i] == b[j]: i += 1 ; j += 1
+	if i > alo: blocks.append((alo, i, blo, j))
+	alo, blo = i, j
+	i, j = ahi, bhi
+	while i > alo and j > blo and a[i - 1] == b[j - 1]: i -= 1 ; j -= 1
+	suffix = (i, ahi, j, bhi) if i < ahi else None
+	ahi, bhi = i, j
+	if alo < ahi and blo < bhi:
+		split = _bisect(a, b, alo, ahi, blo, bhi)
+		if split and split != (alo, blo) and split != (ahi, bhi):
+			_myers(a, b, alo, split[0], blo, split[1], blocks)
+			_myers(a, b, split[0], ahi, split[1], bhi, blocks)
+	if suffix: blocks.append(suffix)
+
+def _bisect( a, b, alo, ahi, blo, bhi, limit=MYERS_LIMIT ):
+	"""Returns the '(I, J)' position where the forward and backward shortest
+	edit paths of 'a[alo:ahi]' and 'b[blo:bhi]' meet, or None when there are
+	more than @limit differences."""
+	n, m   = ahi - alo, bhi - blo
+	dmax   = (n + m + 1) // 2
+	offset = dmax
+	size   = 2 * dmax + 2
+	# The furthest X reached on each diagonal, forward and backward
+	v1, v2 = [-1] * size, [-1] * size
+	v1[offset + 1] = v2[offset + 1] = 0
+	delta  = n - m
+	front  = delta % 2 != 0
+	k1start = k1end = k2start = k2end = 0
+	for d in xrange(min(dmax, limit)):
+		for k1 in xrange(-d + k1start, d + 1 - k1end, 2):
+			k = offset + k1
+			if k1 == -d or (k1 != d and v1[k - 1] < v1[k + 1]): x1 = v1[k + 1]
+			else: x1 = v1[k - 1] + 1
+			y1 = x1 - k1
+			while x1 < n and y1 < m and a[alo + x1] == b[blo + y1]: x1 += 1 ; y1 += 1
+			v1[k] = x1
+			if   x1 > n: k1end   += 2
+			elif y1 > m: k1start += 2
+			elif front:
+				k = offset + delta - k1
+				if 0 <= k < size and v2[k] != -1 and x1 >= n - v2[k]:
+					return (alo + x1, blo + y1)
+		for k2 in xrange(-d + k2start, d + 1 - k2end, 2):
+			k = offset + k2
+			if k2 == -d or (k2 != d and v2[k - 1] < v2[k + 1]): x2 = v2[k + 1]
+			else: x2 = v2[k - 1] + 1
+			y2 = x2 - k2
+			while x2 < n and y2 < m and a[ahi - x2 - 1] == b[bhi - y2 - 1]: x2 += 1 ; y2 += 1
+			v2[k] = x2
+			if   x2 > n: k2end   += 2
+			elif y2 > m: k2start += 2
+			elif not front:
+				k = offset + delta - k2
+				if 0 <= k < size and v1[k] != -1:
+					x1 = v1[k]
+					if x1 >= n - x2:
+						return (alo + x1, blo + x1 - (k - offset))
+	return None
+
+def similarity( a, b ):
+	"""Returns the percentage of the lines of @a that are unchanged in @b,
+	like counting the common lines of 'difflib.ndiff'."""
+	if not a: return 100.0
+	same = sum(a2 - a1 for a1, a2, _, _ in matching_blocks(a, b))
+	return same / float(len(a)) * 100
+
+def diffstat( a, b ):
+	"""Returns the '(ADDED, REMOVED)' number of lines from @a to @b."""
+	same = sum(a2 - a1 for a1, a2, _, _ in matching_blocks(a, b))
+	return len(b) - same, len(a) - same
+
+def opcodes( blocks ):
+	"""Yields the '(TAG, I1, I2, J1, J2)' operations that transform the first
+	sequence into the second, given their matching @blocks."""
+	i = j = 0
+	for a1, a2, b1, b2 in blocks:
+		if   i < a1 and j < b1: yield (REPLACE, i, a1, j, b1)
+		elif i < a1:            yield (DELETE,  i, a1, j, b1)
+		elif j < b1:            yield (INSERT,  i, a1, j, b1)
+		if a2 > a1: yield (EQUAL, a1, a2, b1, b2)
+		i, j = a2, b2
+
+def grouped_opcodes( operations, context=CONTEXT ):
+	"""Groups the given operations in hunks, each one being a list of
+	operations with at most @context lines of equal operations around the
+	changes. This works like 'difflib.SequenceMatcher.get_grouped_opcodes',
+	except that hunks are yielded as soon as they are complete."""
+	group   = []
+	pending = None
+	for op in operations:
+		tag, i1, i2, j1, j2 = op
+		if tag != EQUAL:
+			if not group and pending: group.append(pending)
+			pending = None
+			group.append(op)
+		elif group and i2 - i1 <= 2 * context:
+			group.append(op)
+		else:
+			if group:
+				group.append((EQUAL, i1, i1 + context, j1, j1 + context))
+				yield group
+				group = []
+			pending = (EQUAL, max(i1, i2 - context), i2, max(j1, j2 - context), j2)
+	if group:
+		tag, i1, i2, j1, j2 = group[-1]
+		if tag == EQUAL and i2 - i1 > context:
+			group[-1] = (EQUAL, i1, i1 + context, j1, j1 + context)
+		yield group
+
+# ------------------------------------------------------------------------------
+#
+# INTERNING
+#
+# ------------------------------------------------------------------------------
+
+class Interner:
+	"""Maps lines to integers, the same line being always mapped to the same
+	integer, so that the interned lines of different files can be diffed."""
+
+	def __init__( self ):
+		self.ids = {}
+
+	def intern( self, lines ):
+		"""Returns the array of the integers for the given lines."""
+		ids = self.ids
+		return array.array("l", [ids.setdefault(_, len(ids)) for _ in lines])
+
+def read_interned( *paths ):
+	"""Reads the files at the given paths as arrays of interned lines sharing
+	the same 'Interner', so that only their distinct lines are kept."""
+	interner = Interner()
+	res      = []
+	for path in paths:
+		with open(path, "rb") as f:
+			res.append(interner.intern(f))
+	return res
+
+# ------------------------------------------------------------------------------
+#
+# DIFF
+#
+# ------------------------------------------------------------------------------
+
+class Diff:
+	"""The diff between two lists of lines, viewed as a list of rows in the
+	unified format, where each hunk starts with an '@@' header row. The hunks
+	are grouped as rows are requested, and are stored in compact arrays: the
+	operations of hunk N are 'ops[starts[N]:starts[N+1]]', its rows start
+	at 'offsets[N]' and 'selected[N]' tells if it is selected, which all
+	hunks are by default."""
+
+	def __init__( self, a, b, context=CONTEXT ):
+		self.a        = a
+		self.b        = b
+		self.context  = context
+		self.tags     = array.array("c")
+		self.ops      = array.array("l")
+		self.starts   = array.array("l", [0])
+		self.offsets  = array.array("l", [0])
+		self.selected = array.array("B")
+		self.complete = False
+		self._hunks   = None
+
+	def _group( self ):
+		"""Groups the next hunk, returning False when there are no more."""
+		if self._hunks is None:
+			self._hunks = grouped_opcodes(opcodes(matching_blocks(self.a, self.b)), self.context)
+		for group in self._hunks:
+			rows = 1
+			for tag, i1, i2, j1, j2 in group:
+				self.tags.append(tag)
+				self.ops.extend((i1, i2, j1, j2))
+				rows += (i2 - i1 if tag != INSERT else 0) + (j2 - j1 if tag not in (EQUAL, DELETE) else 0)
+			self.starts.append(len(self.tags))
+			self.offsets.append(self.offsets[-1] + rows)
+			self.selected.append(1)
+			return True
+		self.complete = True
+		return False
+
+	def hunks( self, n=None ):
+		"""Returns the number of hunks, grouping hunks until there are at
+		least @n of them, or all of them when @n is None."""
+		while (n is None or len(self.starts) - 1 < n) and self._group():
+			pass
+		return len(self.starts) - 1
+
+	def rows( self, n=None ):
+		"""Returns the number of rows, grouping hunks until there are at
+		least @n rows, or all of them when @n is None."""
+		while (n is None or self.offsets[-1] < n) and self._group():
+			pass
+		return self.offsets[-1]
+
+	def hunkOps( self, hunk ):
+		"""Returns the '(TAG, I1, I2, J1, J2)' operations of the given hunk."""
+		ops = self.ops
+		return [(self.tags[k],) + tuple(ops[k * 4:k * 4 + 4])
+			for k in range(self.starts[hunk], self.starts[hunk + 1])]
+
+	def hunkRange( self, hunk ):
+		"""Returns the '(A1, A2, B1, B2)' line ranges covered by the given
+		hunk."""
+		first = self.starts[hunk] * 4
+		last  = self.starts[hunk + 1] * 4 - 4
+		return self.ops[first], self.ops[last + 1], self.ops[first + 2], self.ops[last + 3]
+
+	def hunkHeader( self, hunk ):
+		a1, a2, b1, b2 = self.hunkRange(hunk)
+		return "@@ -%d,%d +%d,%d @@" % (a1 + 1 if a2 > a1 else a1, a2 - a1, b1 + 1 if b2 > b1 else b1, b2 - b1)
+
+	def select( self, hunk, state=True ):
+		self.selected[hunk] = 1 if state else 0
+
+	def isSelected( self, hunk ):
+		return self.selected[hunk] == 1
+
+	def isPartial( self ):
+		"""Tells if only some of the hunks are selected. This groups all the
+		hunks."""
+		self.hunks()
+		return 0 < sum(self.selected) < len(self.selected)
+
+	def isEmpty( self ):
+		"""Tells if no hunk is selected (which is the case when there are
+		no differences)."""
+		self.hunks()
+		return not any(self.selected)
+
+	def patched( self ):
+		"""Returns the lines of the first sequence with only the selected
+		hunks applied."""
+		self.hunks()
+		lines = []
+		last  = 0
+		for hunk, selected in enumerate(self.selected):
+			a1, a2, b1, b2 = self.hunkRange(hunk)
+			lines.extend(self.a[last:a1])
+			lines.extend(self.b[b1:b2] if selected else self.a[a1:a2])
+			last = a2
+		lines.extend(self.a[last:])
+		return lines
+
+	def hunkAt( self, row ):
+		"""Returns the hunk that contains the given row, or None when the row
+		is after the end of the diff."""
+		if self.rows(row + 1) <= row: return None
+		return bisect.bisect_right(self.offsets, row) - 1
+
+	def row( self, row ):
+		"""Returns the given row as a '(TAG, TEXT)' couple, where TAG is
+		'@' for hunk headers, or None when the row is after the end of the
+		diff."""
+		hunk = self.hunkAt(row)
+		if hunk is None or row < 0: return None
+		row -= self.offsets[hunk]
+		if row == 0: return ("@", self.hunkHeader(hunk))
+		row -= 1
+		for tag, i1, i2, j1, j2 in self.hunkOps(hunk):
+			if tag != INSERT:
+				if row < i2 - i1: return (EQUAL if tag == EQUAL else DELETE, self.a[i1 + row])
+				row -= i2 - i1
+			if tag not in (EQUAL, DELETE):
+				if row < j2 - j1: return (INSERT, self.b[j1 + row])
+				row -= j2 - j1
+		return None
+
+# ------------------------------------------------------------------------------
+#
+# THREE-WAY MERGE
+#
+# ------------------------------------------------------------------------------
+
+def sync_regions( base, a, b ):
+	"""Returns the '(BASE1, BASE2, A1, A2, B1, B2)' regions where the given
+	lists of lines are all the same, the last one being the empty region at
+	the end of all the lists."""
+	amatches = matching_blocks(base, a)
+	bmatches = matching_blocks(base, b)
+	regions  = []
+	ia = ib  = 0
+	while ia < len(amatches) and ib < len(bmatches):
+		abase1, abase2, a1, _ = amatches[ia]
+		bbase1, bbase2, b1, _ = bmatches[ib]
+		# The region where both blocks match the base
+		start, end = max(abase1, bbase1), min(abase2, bbase2)
+		if start < end:
+			regions.append((start, end,
+				a1 + start - abase1, a1 + end - abase1,
+				b1 + start - bbase1, b1 + end - bbase1))
+		if abase2 < bbase2: ia += 1
+		else:               ib += 1
+	regions.append((len(base), len(base), len(a), len(a), len(b), len(b)))
+	return regions
+
+def merge3( base, a, b, labels=("current", "other") ):
+	"""Merges the changes from @base to @a and from @base to @b (lists of
+	lines), returning '(LINES, CONFLICTS)'. The regions changed differently
+	in both are written between conflict markers (using the given labels),
+	and CONFLICTS is their number."""
+	lines, conflicts = [], 0
+	ibase = ia = ib = 0
+	for base1, base2, a1, a2, b1, b2 in sync_regions(base, a, b):
+		achunk, bchunk = a[ia:a1], b[ib:b1]
+		if achunk or bchunk:
+			bchunk_changed = base[ibase:base1] != bchunk
+			if achunk == bchunk or not bchunk_changed:
+				lines.extend(achunk)
+			elif base[ibase:base1] == achunk:
+				lines.extend(bchunk)
+			else:
+				conflicts += _conflict(lines, achunk, bchunk, labels)
+		lines.extend(base[base1:base2])
+		ibase, ia, ib = base2, a2, b2
+	return lines, conflicts
+
+def _conflict( lines, a, b, labels ):
+	"""Appends the conflicting @a and @b chunks to the given lines, with
+	markers around the part that actually differs, and returns 1, or 0 when
+	they turn out to be the same."""
+	start, end = 0, 0
+	while start < min(len(a), len(b)) and a[start] == b[start]: start += 1
+	while end < min(len(a), len(b)) - start and a[-1 - end] == b[-1 - end]: end += 1
+	lines.extend(a[:start])
+	a, b, suffix = a[start:len(a) - end], b[start:len(b) - end], a[len(a) - end:]
+	if a or b:
+		lines.append(MARKERS[0] % (labels[0]))
+		lines.extend(a)
+		if a and not a[-1].endswith("\n"): lines.append("\n")
+		lines.append(MARKERS[1])
+		lines.extend(b)
+		if b and not b[-1].endswith("\n"): lines.append("\n")
+		lines.append(MARKERS[2] % (labels[1]))
+	lines.extend(suffix)
+	return 1 if a or b else 0
+
+# EOF - vim: tw=80 ts=4 sw=4 noet
@@ -10,19 +10,29 @@
 # Last mod  : 30-Jul-2007
 # -----------------------------------------------------------------------------
 
-# TODO: cache the hg_get_merge_revisions in the conflict file
-
 # Origins:
 #  - http://marc.info/?l=mercurial&m=114719261130043&w=2
 #  - http://marc.info/?t=114719277400001&r=1&w=2
 
-import os, sys, re, shutil, difflib, stat, hashlib, json
-import easyhg.mergetool
+import os, sys, re, time, shutil, difflib, stat, hashlib, json, binascii
+import threading, Queue, contextlib, multiprocessing
+import easyhg.mergetool, easyhg.diff
 from easyhg.output import *
 try:
 	import urwide, urwid
 except:
 	urwide = None
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
 
 __version__ = "0.9.4"
 PROGRAM_NAME = "easymerge"
@@ -42,7 +52,8 @@ Commands :
     list      [DIRECTORY]                     - list registered conflicts
     resolve   [CONFLICT] [keep|update|merge]  - resolves all/given conflict(s)
     unresolve [CONFLICT]                      - sets a conflict as unresolve
-    clean     [DIRECTORY]                     - cleans up the conflict files
+    clean     [--deep] [DIRECTORY]            - cleans up the conflict files
+    automerge [--jobs=N] [CONFLICT]           - merges all/given conflict(s) in-process
     commit                                    - try to commit the changes (TODO)
 
 Usage:
@@ -73,6 +84,13 @@ CONFLICTS_FILE = ".hgconflicts"
 BASE           = "base"
 CURRENT        = "current"
 OTHER          = "other"
+FICLONE        = 0x40049409
+CHUNK_SIZE     = 1024 * 1024
+RACY_DELAY     = 2
+SWEEP_WORKERS  = 8
+LOCK_SUFFIX    = ".lock"
+JOURNAL_SIZE   = 100
+SWEEP_SKIP     = (".hg", ".git", ".svn")
 CLEAN_MATCH    = re.compile("^.+\.(orig|(base|current|other|" + "|".join([OTHER, CURRENT, BASE]) + ")((-r|-pro)\d+)(-\w+)?(\.\d+)?)$")
 
 # -----------------------------------------------------------------------------
@@ -103,6 +121,96 @@ def copy( source, dest ):
 	dest.close()
 	source.close()
 
+def clone( source, dest, link=False ):
+	"""Creates 'dest' with the content of 'source', sharing the data blocks
+	(copy-on-write) when the filesystem supports reflinks. Otherwise 'dest'
+	is a hard link to 'source' when @link is True, which is only safe when
+	neither file is modified in place, or a plain copy. Returns either
+	"reflink", "link" or "copy"."""
+	if os.path.lexists(dest): os.unlink(dest)
+	if fcntl:
+		try:
+			with open(source, "rb") as s:
+				with open(dest, "wb") as d:
+					fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+			return "reflink"
+		except (IOError, OSError):
+			if os.path.lexists(dest): os.unlink(dest)
+	if link:
+		try:
+			os.link(source, dest)
+			return "link"
+		except (AttributeError, OSError):
+			pass
+	shutil.copyfile(source, dest)
+	return "copy"
+
+def same_content( a, b ):
+	"""Tells if the files at the given paths have the same content, without
+	reading them when they are the same file or differ in size."""
+	sa, sb = os.stat(a), os.stat(b)
+	if (sa.st_dev, sa.st_ino) == (sb.st_dev, sb.st_ino): return True
+	if sa.st_size != sb.st_size: return False
+	with open(a, "rb") as fa:
+		with open(b, "rb") as fb:
+			while True:
+				ca, cb = fa.read(CHUNK_SIZE), fb.read(CHUNK_SIZE)
+				if ca != cb: return False
+				if not ca:   return True
+
+def signature( path ):
+	"""Returns the SHA-256 of the file at the given path, reading it by
+	chunks. A missing file has the signature of an empty file."""
+	sig = hashlib.sha256()
+	if os.path.exists(path):
+		with open(path, "rb") as f:
+			for chunk in iter(lambda:f.read(CHUNK_SIZE), ""):
+				sig.update(chunk)
+	return sig.hexdigest()
+
+def mtime_ns( st ):
+	"""Returns the modification time of the given stat result in
+	nanoseconds."""
+	return getattr(st, "st_mtime_ns", None) or int(st.st_mtime * 1000000000)
+
+def listdir( path ):
+	"""Returns the '(NAME, PATH, IS_DIRECTORY)' of the entries of the given
+	directory, where symbolic links are never directories."""
+	if scandir:
+		return [(_.name, _.path, _.is_dir(follow_symlinks=False)) for _ in scandir(path)]
+	res = []
+	for name in os.listdir(path):
+		p = os.path.join(path, name)
+		res.append((name, p, os.path.isdir(p) and not os.path.islink(p)))
+	return res
+
+def sweep( root, match=CLEAN_MATCH, workers=SWEEP_WORKERS ):
+	"""Returns the sorted paths of the files under the given root whose name
+	matches, listing the directories with a pool of @workers threads and
+	skipping the SWEEP_SKIP directories."""
+	pending = Queue.Queue()
+	found   = []
+	def worker():
+		while True:
+			directory = pending.get()
+			try:
+				for name, path, is_dir in listdir(directory):
+					if is_dir:
+						if name not in SWEEP_SKIP: pending.put(path)
+					elif match.match(name):
+						found.append(path)
+			except OSError:
+				pass
+			finally:
+				pending.task_done()
+	pending.put(root)
+	for _ in range(workers):
+		thread = threading.Thread(target=worker)
+		thread.setDaemon(True)
+		thread.start()
+	pending.join()
+	return sorted(found)
+
 def backup_existing( path ):
 	"""If the given path exists and is a file, the path will be copied to a file
 	in the same directory, with the same name suffixed by a number (.1, .2, .3),
@@ -130,6 +238,26 @@ def diff_count( a, b ):
 			no_conflict += 1
 	return no_conflict / float(len(a)) * 100
 
+def automerge( paths ):
+	"""Merges the changes from BASE to CURRENT and from BASE to OTHER into
+	LOCAL (given as a '(LOCAL, CURRENT, BASE, OTHER)' tuple of paths) with
+	'easyhg.diff.merge3', returning '(LOCAL, STATUS, CONFLICTS)'. STATUS is
+	"merged" when the local file was written, with CONFLICTS regions between
+	conflict markers, and otherwise tells why it was not: "missing",
+	"binary" or "modified" (when the local file differs from CURRENT)."""
+	local, current, base, other = paths
+	texts = []
+	for path in paths:
+		if not os.path.isfile(path): return (local, "missing", 0)
+		with open(path, "rb") as f: texts.append(f.read())
+	if any("\0" in _ for _ in texts): return (local, "binary", 0)
+	if texts[0] != texts[1]: return (local, "modified", 0)
+	split = easyhg.diff.splitlines
+	lines, conflicts = easyhg.diff.merge3(split(texts[2]), split(texts[1]), split(texts[3]), (CURRENT, OTHER))
+	with open(local, "wb") as f:
+		f.write("".join(lines))
+	return (local, "merged", conflicts)
+
 # -----------------------------------------------------------------------------
 #
 # UI
@@ -364,7 +492,7 @@ class ConsoleUI(urwide.Handler):
 		self.ui.handler(self)
 		self.ui.data.conflicts = conflicts
 		self.ui.strings.RESOLVED   = "RESOLVED    [U]nresolve | Re[V]iew | Diff: [C]urrent, [O]ther | [S]ources | [Q]uit"
-		self.ui.strings.UNRESOLVED = "UNRESOLVED  [R]esolve   | Re[V]iew | Diff: [C]urrent, [O]ther | [S]ources | [Q]uit"
+		self.ui.strings.UNRESOLVED = "UNRESOLVED  [R]esolve   | [A]uto-merge all | Re[V]iew | Diff: [C]urrent, [O]ther | [S]ources | [Q]uit"
 
 	def conflicts( self ):
 		"""Returns the conflicts associated with this UI."""
@@ -397,7 +525,10 @@ class ConsoleUI(urwide.Handler):
 			console_ui = CONSOLE_UI.replace("$REVINFO", "\n".join(["Txt  " + l for l in self.mergeInfo().split("\n")]))
 			self.ui.create(CONSOLE_STYLE, console_ui)
 			self.updateConflicts()
-			self.ui.main()
+			try:
+				self.ui.main()
+			finally:
+				self.conflicts().sync()
 		else:
 			print ("No conflicts found.")
 
@@ -467,7 +598,7 @@ class ConsoleUI(urwide.Handler):
 			if path == conflict.path():
 				return "This is the local file"
 			sig_local = conflict._sig(conflict.current())
-			sig_right = hashlib.sha256(conflict._read(path)).hexdigest()
+			sig_right = conflict._sig(path)
 			if sig_local == sig_right: return "Same content as the local file"
 			else: return "Not same content as local file: " + sig_right
 		if conflict.state == Conflict.RESOLVED:
@@ -527,6 +658,8 @@ class ConsoleUI(urwide.Handler):
 				self.ops.reviewConflict(conflict, "local", "current")
 			elif key == "s":
 				self.ops.reviewConflictSources(conflict)
+			elif key == "a":
+				self.onAutoMerge(widget)
 			# Selects the current choice
 			# Selects the current choice
 			elif key == "enter" or key == "r":
@@ -538,10 +671,22 @@ class ConsoleUI(urwide.Handler):
 				self._updateConflictView(conflict)
 		return True
 
+	def onAutoMerge( self, widget ):
+		"""Merges all the unresolved conflicts with the built-in three-way
+		merge."""
+		summary  = self.ops.autoMergeConflicts()
+		resolved = len([_ for _ in summary if _[1] == "resolved"])
+		self.updateConflicts()
+		self.main_ui.tooltip("{0} of {1} conflicts were resolved by merging {2} and {3}".format(
+			resolved, len(summary), CURRENT, OTHER))
+		return True
+
 	def onKeyPress( self, widget, key ):
 		if  key == "q":
 			self.ui.end()
 			return True
+		elif key == "a":
+			return self.onAutoMerge(widget)
 		elif key == "c":
 			if not self.ui.data.conflicts.unresolved():
 				# TODO: Detect if commit was successful or not
@@ -624,6 +769,18 @@ class Conflict:
 	def fromJSON( self, kwargs ):
 		return Conflict(**kwargs)
 
+	def update( self, kwargs ):
+		"""Updates this conflict from the given 'toJSON' data."""
+		self.number       = kwargs["number"]
+		self.state        = kwargs.get("state") or Conflict.UNRESOLVED
+		self.provisional  = kwargs.get("provisional", False)
+		self.description  = kwargs.get("description", "")
+		self._path        = kwargs["path"]
+		self._currentPath = kwargs["currentPath"]
+		self._basePath    = kwargs["basePath"]
+		self._otherPath   = kwargs["otherPath"]
+		return self
+
 	def getState( self ):
 		"""Returns the state for this conflict (Conflict.RESOLVED or
 		Conflict.UNRESOLVED)"""
@@ -643,20 +800,19 @@ class Conflict:
 		# We backup .orig, .base and .new that may already be tehre
 		backups = []
 		for p,o in ((base_copy, base_path), (current_copy, current_path), (other_copy, other_path)):
-			if os.path.exists(p):
-				with open(p) as f: pt = f.read()
-				with open(o) as f: ot = f.read()
-				if pt != ot:
+			if os.path.exists(p) and os.path.exists(o):
+				if not same_content(p, o):
 					suffix  = 0
 					prefix  = p + ".backup"
 					path    = prefix
 					while os.path.exists(path):
-						path = prefix + suffix
+						path = "%s.%d" % (prefix, suffix)
 						suffix += 1
 					backups.append((p,path))
 		for o,n in backups:
 			warning("Previous conflict files present and differ, backing up {0} as {1}".format(o,n))
 			shutil.move(o, n)
+			if self.conflicts: self.conflicts.addArtifact(n)
 		# And we create the new ones
 		info(u"Provisioning conflict for {0}".format(self._path))
 		info(u"◌ LOCAL   = {0}".format(self._path))
@@ -670,10 +826,12 @@ class Conflict:
 				else:
 					shutil.move(o, n)
 					os.chmod(n, stat.S_IREAD|stat.S_IRUSR|stat.S_IRGRP)
+					if self.conflicts: self.conflicts.addArtifact(n)
 		self.provisional  = False
 		self._currentPath = current_copy
 		self._basePath    = base_copy
 		self._otherPath   = other_copy
+		if self.conflicts: self.conflicts.touch(self)
 		return self
 
 	def describe( self ):
@@ -694,9 +852,11 @@ class Conflict:
 
 	def resolve(self):
 		self.state = self.RESOLVED
+		if self.conflicts: self.conflicts.touch(self)
 
 	def unresolve(self):
 		self.state = self.UNRESOLVED
+		if self.conflicts: self.conflicts.touch(self)
 
 	def path( self ):
 		return self._path
@@ -742,7 +902,8 @@ class Conflict:
 		return r
 
 	def _sig( self, path ):
-		return hashlib.sha256(self._read(path)).hexdigest()
+		if self.conflicts: return self.conflicts.signature(path)
+		return signature(path)
 
 	def _sigs( self ):
 		return self._sig(self.path()), self._sig(self.current()), \
@@ -806,7 +967,15 @@ class Conflict:
 class Conflicts:
 	"""This is a utility class that represents the list of conflicts, and
 	whether they are resolved or not. It is used by all commands, and makes it
-	 to manage the conflicts file."""
+	 to manage the conflicts file.
+
+	The conflicts are indexed by number and by path. The conflicts file starts
+	with a JSON snapshot of the conflicts, followed by a journal of JSON
+	records (one per line) appended by each 'save', which only contain what
+	changed. Saves are done under a lock, after applying the records that
+	other easymerge processes saved in the meantime, and the journal is
+	compacted into a new snapshot once it has more records than there are
+	conflicts."""
 
 	def __init__( self, path="." ):
 		# We look for the base directory where the conflicts file is located
@@ -818,7 +987,7 @@ class Conflicts:
 			if os.path.isfile(conflicts_path): break
 			if os.path.isdir(hg_path): break
 			last_path   = search_path
-			search_path = os.path.basename(last_path)
+			search_path = os.path.dirname(last_path)
 		# We modify the path to be the search path if we found either a HG repo
 		# or a conflicts file
 		if last_path != search_path: path = search_path
@@ -828,6 +997,10 @@ class Conflicts:
 		self._currentInfo = None
 		self._baseInfo    = None
 		self._otherInfo   = None
+		self._revs        = None
+		self._revsParents = None
+		self._signatures  = {}
+		self._artifacts   = set()
 		self.load()
 
 	def getCurrentInfo(self):
@@ -848,15 +1021,99 @@ class Conflicts:
 	def setOtherInfo(self,info):
 		self._otherInfo = info
 
+	def getPath( self ):
+		"""Returns the path of the conflicts file."""
+		return self._path
+
+	def addArtifact( self, path ):
+		"""Records the given file as created by easymerge, so that it is
+		removed by 'Operations.clean'."""
+		path = os.path.abspath(path)
+		if path not in self._artifacts:
+			self._artifacts.add(path)
+			self._newArtifacts.add(path)
+
+	def artifacts( self ):
+		"""Returns the sorted paths of the files created by easymerge for
+		these conflicts, which may not all exist anymore. This includes the
+		sources of the conflicts and the '.orig' files left by Mercurial."""
+		res = set(self._artifacts)
+		for c in self._conflicts:
+			res.update((c.current(), c.base(), c.other()))
+			if c.path(): res.add(c.path() + ".orig")
+		return sorted(res)
+
 	def getRevs( self ):
-		return hg_get_merge_revisions(os.path.dirname(self._path))
+		"""Returns the merge revisions (see 'hg_get_merge_revisions'). As
+		Mercurial runs easymerge once per conflicting file, they are only
+		computed once for the working directory parents, and cached in the
+		conflicts file."""
+		parents = hg_get_parents(os.path.dirname(self._path))
+		if self._revs is None or parents is None or parents != self._revsParents:
+			self._revs        = hg_get_merge_revisions(os.path.dirname(self._path))
+			self._revsParents = parents
+		return self._revs
+
+	def signature( self, path ):
+		"""Returns the signature of the file at the given path (see
+		'signature'), which is cached by '(PATH, INODE, SIZE, MTIME_NS)' and
+		saved in the conflicts file, so that the read-only conflict sources
+		are only hashed once. Files modified in the last RACY_DELAY seconds
+		are not cached, as they may change again within the same mtime."""
+		try:
+			st = os.stat(path)
+		except OSError:
+			return signature(path)
+		key    = [st.st_ino, st.st_size, mtime_ns(st)]
+		cached = self._signatures.get(path)
+		if cached and cached[:3] == key: return cached[3]
+		sig = signature(path)
+		if time.time() - st.st_mtime > RACY_DELAY:
+			self._signatures[path]    = key + [sig]
+			self._newSignatures[path] = key + [sig]
+		return sig
+
+	def sync( self ):
+		"""Saves the conflicts file when signatures were cached since it was
+		loaded or saved."""
+		if self._newSignatures and os.path.isfile(self._path):
+			self.save()
+
+	def touch( self, conflict ):
+		"""Marks the given conflict as changed, so that it is saved by the
+		next 'save'."""
+		self._dirty[id(conflict)] = conflict
+
+	@contextlib.contextmanager
+	def lock( self, shared=False ):
+		"""Locks the conflicts file for the duration of the 'with' block,
+		through a lock file next to it (as the conflicts file is replaced
+		when compacted)."""
+		if not fcntl:
+			yield
+			return
+		with open(self._path + LOCK_SUFFIX, "a") as f:
+			fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
 	def load( self ):
 		"""Reads the conflicts from the file, if it exists"""
-		self._conflicts = []
-		revs = hg_get_merge_revisions(os.path.dirname(self._path))
+		self._conflicts     = []
+		self._byNumber      = {}
+		self._byPath        = {}
+		self._next          = 0
+		self._dirty         = {}
+		self._newSignatures = {}
+		self._newArtifacts  = set()
+		self._savedInfo     = self._info()
+		self._stamp         = None
+		self._journal       = 0
 		if not os.path.isfile(self._path):
-			self.setCurrentInfo(revs[0])
+			revs = self.getRevs()
+			if revs: self.setCurrentInfo(revs[0])
 			if len(revs) < 3:
 				return False
 			# NOTE: Sometimes we might have more than 3 revisions, not sure
@@ -867,23 +1124,21 @@ class Conflicts:
 			self.setOtherInfo(oi)
 			return True
 		else:
-			with open(self._path, "r") as f:
-				data = json.load(f)
-			self.setCurrentInfo(data["current"])
-			self.setBaseInfo(data["base"])
-			self.setOtherInfo(data["other"])
-			self._conflicts = [
-				Conflict.fromJSON(_) for _ in data["conflicts"]
-			]
-			# If we have no base then we need to expand the conflicts now
-			if data["base"] is None and len(revs) >= 3:
+			with self.lock(shared=True):
+				self._refresh()
+			# The cached revisions are only reused for the same parents
+			revs = self.getRevs()
+			# If we have provisional conflicts (registered while Mercurial was
+			# merging) then we need to expand them now
+			provisional = self.getBaseInfo() is None or any(_.provisional for _ in self._conflicts)
+			if provisional and len(revs) >= 3:
 				self.setCurrentInfo(revs[0])
 				self.setOtherInfo  (revs[1])
 				self.setBaseInfo   (revs[2])
 				self._conflicts = [_.provision(revs[0], revs[1], revs[2]) for _ in self._conflicts]
 				self.save()
 			else:
-				if len(revs) >= 0:
+				if len(revs) >= 1:
 					self.setCurrentInfo(revs[0])
 				else:
 					self.setCurrentInfo(("N/A","N/A","N/A"))
@@ -897,39 +1152,182 @@ class Conflicts:
 					self.setBaseInfo(("N/A","N/A","N/A"))
 				# Sometimes we don't have all this.
 				pass
-			for c in self._conflicts:
-				c.conflicts = self
 
 	def save( self ):
-		"""Writes back the conflicts to the file, overwriting it."""
-		with open(self._path, "w") as f:
-			 json.dump(dict(
-				current = self.getCurrentInfo(),
-				other   = self.getOtherInfo(),
-				base    = self.getBaseInfo(),
-				conflicts = [_.toJSON() for _ in self._conflicts]
-			), f)
+		"""Saves the changes made since the conflicts were loaded or saved, by
+		appending them to the journal of the conflicts file (or by writing a
+		new snapshot when it is compacted)."""
+		with self.lock():
+			self._refresh()
+			records = self._records()
+			if os.path.isfile(self._path) and not records: return
+			if not os.path.isfile(self._path) \
+			or self._journal + len(records) > max(JOURNAL_SIZE, len(self._conflicts)):
+				self._compact()
+			else:
+				self._append(records)
+			self._dirty         = {}
+			self._newSignatures = {}
+			self._newArtifacts  = set()
+			self._savedInfo     = self._info()
+
+	def _info( self ):
+		# The info is normalized as it would be read back from JSON
+		return json.loads(json.dumps(dict(
+			current   = self.getCurrentInfo(),
+			other     = self.getOtherInfo(),
+			base      = self.getBaseInfo(),
+			parents   = self._revsParents,
+			revisions = self._revs,
+		)))
+
+	def _records( self ):
+		"""Returns the journal records for the changes that were not saved."""
+		records = [{"conflict":_.toJSON()} for _ in sorted(self._dirty.values(), key=lambda _:_.number)]
+		if self._newSignatures:
+			records.append({"signatures":self._newSignatures})
+		if self._newArtifacts:
+			records.append({"artifacts":sorted(self._newArtifacts)})
+		info = self._info()
+		if info != self._savedInfo:
+			records.append({"info":info})
+		return records
+
+	def _refresh( self ):
+		"""Applies the records saved (by this or other processes) since the
+		file was last read or written, reading it from the snapshot when it
+		was compacted in the meantime."""
+		if not os.path.isfile(self._path): return
+		st = os.stat(self._path)
+		if self._stamp and self._stamp[0] == st.st_ino:
+			offset = self._stamp[1]
+			if offset == st.st_size: return
+		else:
+			offset = 0
+			self._journal = -1
+		with open(self._path, "rb") as f:
+			f.seek(offset)
+			for line in f:
+				# A partial line can only come from an interrupted write
+				try:
+					record = json.loads(line)
+				except ValueError:
+					break
+				offset += len(line)
+				self._journal += 1
+				self._apply(record)
+		self._stamp = (st.st_ino, offset)
+
+	def _apply( self, record ):
+		"""Applies the given snapshot or journal record. The changes that
+		were not saved yet take precedence over the applied ones."""
+		if "conflicts" in record:
+			self._apply({"info":dict((_, record.get(_)) for _ in ("current", "other", "base", "parents", "revisions"))})
+			self._apply({"signatures":record.get("signatures") or {}})
+			self._apply({"artifacts":record.get("artifacts") or []})
+			for _ in record["conflicts"]: self._apply({"conflict":_})
+		elif "conflict" in record:
+			self._applyConflict(record["conflict"])
+		elif "signatures" in record:
+			for path, sig in record["signatures"].items():
+				if path not in self._newSignatures: self._signatures[path] = sig
+		elif "artifacts" in record:
+			self._artifacts.update(record["artifacts"])
+		elif "info" in record:
+			info = record["info"]
+			if self._info() == self._savedInfo:
+				self.setCurrentInfo(info.get("current"))
+				self.setOtherInfo(info.get("other"))
+				self.setBaseInfo(info.get("base"))
+				self._revsParents = info.get("parents")
+				self._revs        = info.get("revisions")
+			self._savedInfo = info
+
+	def _applyConflict( self, data ):
+		conflict = self._byNumber.get(data["number"])
+		if conflict and id(conflict) in self._dirty:
+			# Our changes win, unless another process registered another
+			# conflict with the same number, in which case ours is renumbered
+			if conflict.path() == data["path"]: return
+			self._unindex(conflict)
+			conflict.number = self._next
+			self._index(conflict)
+			conflict = None
+		same = self._byPath.get(data["path"])
+		if same and same is not conflict:
+			# The same file was registered by another process
+			self._unindex(same)
+			self._dirty.pop(id(same), None)
+			self._conflicts.remove(same)
+		if conflict:
+			self._unindex(conflict)
+			conflict.update(data)
+		else:
+			conflict = Conflict.fromJSON(data)
+			conflict.conflicts = self
+			self._conflicts.append(conflict)
+		self._index(conflict)
+
+	def _index( self, conflict ):
+		self._byNumber[conflict.number] = conflict
+		self._byPath[conflict.path()]   = conflict
+		self._next = max(self._next, conflict.number + 1)
+
+	def _unindex( self, conflict ):
+		self._byNumber.pop(conflict.number, None)
+		self._byPath.pop(conflict.path(), None)
+
+	def _append( self, records ):
+		with open(self._path, "ab+") as f:
+			# Files written by previous versions have no trailing EOL
+			f.seek(0, os.SEEK_END)
+			if f.tell():
+				f.seek(-1, os.SEEK_END)
+				if f.read(1) != "\n": f.write("\n")
+			f.write("".join(json.dumps(_) + "\n" for _ in records))
+			f.flush()
+			st = os.fstat(f.fileno())
+		self._journal += len(records)
+		self._stamp    = (st.st_ino, st.st_size)
+
+	def _compact( self ):
+		snapshot = self._info()
+		snapshot["signatures"] = self._signatures
+		snapshot["artifacts"]  = sorted(self._artifacts)
+		snapshot["conflicts"]  = [_.toJSON() for _ in self._conflicts]
+		tmp = self._path + ".tmp"
+		with open(tmp, "wb") as f:
+			json.dump(snapshot, f)
+			f.write("\n")
+		os.rename(tmp, self._path)
+		st = os.stat(self._path)
+		self._journal = 0
+		self._stamp   = (st.st_ino, st.st_size)
 
 	def all( self ):
 		return self._conflicts
 
+	def get( self, number ):
+		"""Returns the conflict with the given number, or None."""
+		return self._byNumber.get(number)
+
 	def resolved( self, number=None ):
 		"""Returns the list of resolved conflicts"""
 		if number == None:
 			return filter(lambda c:c.state == Conflict.RESOLVED, self._conflicts)
 		else:
-			res = filter(lambda c:c.state == Conflict.RESOLVED and c.number == number, self._conflicts)
-			if not res: return None
-			else: return res[0]
+			res = self._byNumber.get(number)
+			if not res or res.state != Conflict.RESOLVED: return None
+			else: return res
 
 	def unresolved( self, number=None):
 		"""Returns the list of unresolved conflicts"""
 		if number == None:
 			return tuple(c for c in self._conflicts if c.state == Conflict.UNRESOLVED)
 		else:
-			res = filter(lambda c:c.state == Conflict.UNRESOLVED and c.number == number, self._conflicts)
-			if not res: return None
-			else: return res[0]
+			res = self._byNumber.get(number)
+			if not res or res.state != Conflict.UNRESOLVED: return None
+			else: return res
 
 	def register( self, current, base, other ):
 		"""Registers a new conflict, which creates provisional files for the
@@ -940,37 +1338,39 @@ class Conflicts:
 			if not os.path.exists(p):
 				error("Cannot register conflict as file is missing: {0}".format(p))
 				return False
-		rev = hg_get_merge_revisions(os.path.dirname(self._path))[0]
+		rev = self.getRevs()[0]
 		base_provisional     = current + ".base-pro"    + rev[0]
 		current_provisional  = current + ".current-pro" + rev[0]
 		other_provisional    = current + ".other-pro"   + rev[0]
-		shutil.copyfile(base,  base_provisional)
-		shutil.copyfile(other, other_provisional)
-		shutil.copyfile(current, current_provisional)
+		# Mercurial's base and other files are temporary and never modified,
+		# so they can be hard linked, while the current file is the one that
+		# will be merged in place.
+		clone(base,    base_provisional,    link=True)
+		clone(other,   other_provisional,   link=True)
+		clone(current, current_provisional)
+		for _ in (base_provisional, other_provisional, current_provisional):
+			self.addArtifact(_)
 		self.add(current, current_provisional, base_provisional, other_provisional, True)
 
 	def add( self, path, currentPath, basePath, otherPath, provisional=False ):
-		"""Adds a new conflict between the given files, and returns the conflict
-		as a (STATE, ID, FILES) triple."""
+		"""Adds a new conflict between the given files, and returns the
+		conflict. A conflict is only added once for the same path."""
 		path    = os.path.abspath(path) if path else None
 		base    = os.path.abspath(basePath)
 		other   = os.path.abspath(otherPath)
 		current = os.path.abspath(currentPath)
-		next    = 0
 		# We do not add a conflict twice
-		for c in self._conflicts:
-			if  c.path()  != path \
-			and c.other() != other:
-				next += 1
-			else:
-				return c
+		if path in self._byPath:
+			return self._byPath[path]
 		# Eventually adds the conflict
-		next     = len(self.unresolved())
-		conflict = Conflict(next, path, current, base, other, provisional=provisional)
+		conflict = Conflict(self._next, path, current, base, other, provisional=provisional)
 		assert other   == conflict.other(), "Internal error"
 		assert current == conflict.current(), "Internal error"
 		assert base    == conflict.base(), "Internal error"
+		conflict.conflicts = self
 		self._conflicts.append(conflict)
+		self._index(conflict)
+		self.touch(conflict)
 		return conflict
 
 	def asString(self, color=False):
@@ -1157,6 +1557,39 @@ class Operations:
 				# FIXME: Add choice of action
 				self.resolveConflict(number)
 
+	def autoMergeConflicts( self, *numbers, **options ):
+		"""Merges the given unresolved conflicts (all of them by default) with
+		the built-in three-way merge (see 'automerge'), using a pool of
+		'workers' processes. The conflicts merged without overlapping changes
+		are resolved, the others get conflict markers in their local file.
+		Returns the summary as a list of '(CONFLICT, STATUS)'."""
+		workers   = options.get("workers")
+		conflicts = []
+		for number in numbers or [_.number for _ in self.conflicts.unresolved()]:
+			conflict = self.getUnresolvedConflict(number)
+			if conflict: conflicts.append(conflict)
+		jobs = [(_.path(), _.current(), _.base(), _.other()) for _ in conflicts]
+		if len(jobs) <= 1 or workers == 1:
+			results = map(automerge, jobs)
+		else:
+			pool = multiprocessing.Pool(workers)
+			try:
+				results = pool.map(automerge, jobs)
+			finally:
+				pool.close()
+				pool.join()
+		summary = []
+		for conflict, (path, status, count) in zip(conflicts, results):
+			if status == "merged" and not count:
+				conflict.resolve()
+				summary.append((conflict, "resolved"))
+			elif status == "merged":
+				summary.append((conflict, "{0} overlapping change(s) marked".format(count)))
+			else:
+				summary.append((conflict, "skipped, {0}".format(status)))
+		self.conflicts.save()
+		return summary
+
 	def resolveConflict( self, number, method="merge" ):
 		if method == "keep":
 			return self.resolveConflictByKeepingLocal(number)
@@ -1193,6 +1626,7 @@ class Operations:
 					next_merge = conflict.nextMerge()
 					self.log("Backing up current resolution conflict as: %s" % (next_merge))
 					copy(conflict.path(), next_merge)
+					conflicts.addArtifact(next_merge)
 					backups.append(next_merge)
 				conflict.unresolve()
 				copy(conflict.current(), conflict.path())
@@ -1201,24 +1635,21 @@ class Operations:
 		conflicts.save()
 		return backups
 
-	def clean( self ):
-		"""Cleans the given directory from the conflict backup files and from the
-		conflicts file itself."""
-		rootdir = self.conflicts.root
-		# If there is a conflicts file, we remove it
-		conflicts_file = os.path.join(rootdir, CONFLICTS_FILE)
-		to_clean = []
-		if os.path.isfile(conflicts_file): to_clean.append(conflicts_file)
-		# And we clean the directory
-		for root, dirs, files in os.walk(rootdir):
-			for name in files:
-				if CLEAN_MATCH.match(name):
-					path = os.path.join(root, name)
-					to_clean.append(cutpath(rootdir, path))
-			# if ".hg" in dirs:
-			# 	dirs.remove(".hg")
+	def clean( self, deep=False ):
+		"""Cleans up the files created by easymerge, as recorded in the
+		conflicts file, and the conflicts file itself. When @deep is True, the
+		directory is also swept for leftover merge files (see 'sweep'), which
+		is only needed when the conflicts file is lost or outdated."""
+		rootdir  = self.conflicts.root
+		to_clean = [_ for _ in self.conflicts.artifacts() if os.path.isfile(_)]
+		if deep:
+			to_clean = sorted(set(to_clean).union(sweep(rootdir)))
+		# If there is a conflicts file (and its lock), we remove it
+		conflicts_file = self.conflicts.getPath()
+		for _ in (conflicts_file, conflicts_file + LOCK_SUFFIX):
+			if os.path.isfile(_): to_clean.append(_)
 		for _ in to_clean:
-			self.info("Cleaning up: " + _)
+			self.info("Cleaning up: " + cutpath(rootdir, _))
 			os.unlink(_)
 		if len(to_clean) == 0:
 			self.info("No leftover merge files to cleanup")
@@ -1229,32 +1660,42 @@ class Operations:
 #
 # -----------------------------------------------------------------------------
 
+REVISION_TEMPLATE = "{rev}\\0{author}\\0{date|date}\\n"
+
 def hg_get_revision_info(rev, path="."):
-	detail = os.popen("cd '%s' ; hg log -r%s" % (path,rev)).read().decode("utf-8")
-	info  = []
-	for line in detail.split("\n"):
-		if line.startswith("user:"):
-			info.append(line[5:].strip())
-		elif line.startswith("date:"):
-			info.append(line[5:].strip())
-	return info
+	"""Returns the '[USER, DATE]' of the given revision."""
+	info = hg_get_revisions_info(rev, path)
+	return info[0][1:] if info else []
+
+def hg_get_revisions_info(revs, path="."):
+	"""Returns a list of '[REV, USER, DATE]' for the given revision set, using
+	a single 'hg log'."""
+	detail = os.popen("hg --repository '%s' log -r '%s' --template '%s'" % (path, revs, REVISION_TEMPLATE)).read().decode("utf-8")
+	return [_.split("\0") for _ in detail.split("\n") if _]
+
+def hg_get_parents(path="."):
+	"""Returns the working directory parents as an hexadecimal string read
+	from the dirstate (so without running 'hg'), or None when there is no
+	dirstate at the given path."""
+	try:
+		with open(os.path.join(path, ".hg", "dirstate"), "rb") as f:
+			header = f.read(76)
+	except IOError:
+		return None
+	# Dirstate-v2 files start with a marker followed by the two parents
+	if header.startswith("dirstate-v2\n"): header = header[12:]
+	else: header = header[:40]
+	return binascii.hexlify(header)
 
 # FIXME: This should not be necessary once I get the proper values from
 # Mercurial
 def hg_get_merge_revisions(path="."):
-	"""Returns a tuple (CURRENT, PARENT, OTHER) where each value is a couple
-	(REV, CHANGESET ID)."""
-	lines = os.popen("hg --repository {0} id -n".format(path)).read().decode("utf8").split("\n")
-	revs  = [_ for _ in lines[0].split("+") if _]
-	if len(revs) >= 2:
-		ancestor = os.popen( "hg --repository {0} id -n -r'ancestor({1},{2})'".format(path, revs[0], revs[1])).read().decode("utf8")
-		revs.append(ancestor.split("\n")[0])
-	res   = []
-	for rev in revs:
-		if rev:
-			info = [rev]
-			info.extend(hg_get_revision_info(rev, path))
-			res.append(info)
+	"""Returns a tuple (CURRENT, PARENT, OTHER) where each value is a
+	'[REV, USER, DATE]' list. This runs at most two 'hg' commands, and is
+	cached by 'Conflicts.getRevs'."""
+	res = hg_get_revisions_info("parents()", path)
+	if len(res) >= 2:
+		res.extend(hg_get_revisions_info("ancestor({0},{1})".format(res[0][0], res[1][0]), path))
 	return res
 
 RE_NUMBER = re.compile("\d+")
@@ -1289,6 +1730,22 @@ def run(args):
 		for number, method in conflicts:
 			ops.resolveConflict(number, method)
 		return 0
+	# Command: automerge [--jobs=N] [CONFLICT...]
+	elif len(args) >= 1 and args[0] == "automerge":
+		ops     = Operations(Conflicts(root))
+		workers = None
+		numbers = []
+		for a in args[1:]:
+			if a.startswith("--jobs="):
+				workers = max(1, int(a.split("=", 1)[1]))
+			elif RE_NUMBER.match(a):
+				numbers.append(int(a))
+		summary = ops.autoMergeConflicts(*numbers, workers=workers)
+		for conflict, status in summary:
+			ops.output("%-4s\t%s: %s" % (conflict.number, cutpath(root, conflict.path()), status))
+		resolved = len([_ for _ in summary if _[1] == "resolved"])
+		info("{0} of {1} conflicts resolved".format(resolved, len(summary)))
+		return 0
 	# Command: unresolved CONFLICT...
 	elif len(args) >= 2 and args[0] == "unresolve":
 		conflicts = args[1:]
@@ -1296,14 +1753,19 @@ def run(args):
 		ops  = Operations(Conflicts(root))
 		ops.unresolve(*conflicts)
 		return 0
-	# Command: clean [DIRECTORY]
-	elif len(args) in (1,2) and args[0].startswith("clean"):
+	# Command: clean [--deep] [DIRECTORY]
+	elif len(args) in (1,2,3) and args[0].startswith("clean"):
+		deep = "--deep" in args[1:]
+		rest = [_ for _ in args[1:] if _ != "--deep"]
+		if len(rest) > 1:
+			print (USAGE)
+			return -1
 		# The directory to be cleaned up may be given, so we ensure it is
 		# present
-		if len(args) == 2: root = os.path.abspath(args[1])
+		if rest: root = os.path.abspath(rest[0])
 		ops  = Operations(Conflicts(root))
 		# We clean the directory
-		ops.clean()
+		ops.clean(deep)
 		return 0
 	# Command: commit
 	elif len(args) == 1 and args[0] == "commit":
@@ -4,7 +4,7 @@
 # -----------------------------------------------------------------------------
 # Project   : URWIDE - Extended URWID
 # -----------------------------------------------------------------------------
-# Author    : Sbastien Pierre                           <sebastien@type-z.org>
+# Author    : S�bastien Pierre                           <sebastien@type-z.org>
 # License   : Lesser GNU Public License  http://www.gnu.org/licenses/lgpl.html>
 # -----------------------------------------------------------------------------
 # Creation  : 14-Jul-2006
@@ -822,7 +822,12 @@ class Console(UI):
 				if focused.w: focused = focused.w
 			if isinstance(focused, urwid.Filler):
 				if focused.w: focused = focused.w
-			if hasattr(focused, "get_focus"):
+			if isinstance(focused, urwid.BoxAdapter):
+				focused = focused.box_widget
+			# Nested list boxes return a (widget, position) couple
+			if isinstance(focused, urwid.ListBox):
+				if focused.get_focus()[0]: focused = focused.get_focus()[0]
+			elif hasattr(focused, "get_focus"):
 				if focused.get_focus(): focused = focused.get_focus()
 		return focused
 
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# Encoding: utf8
+# -----------------------------------------------------------------------------
+# Project   : Mercurial - Easy tools
+# -----------------------------------------------------------------------------
+# Creation  : 19-Oct-2026
+# Last mod  : 19-Oct-2026
+# -----------------------------------------------------------------------------
+# Guards the cost of loading the 'easycommit' extension, which Mercurial does
+# for every command: importing 'easyhg.commit' must not import the user
+# interface nor Mercurial's command table, and must stay fast.
+#
+# Usage: python tests/import-time.py [RUNS] [MAX_MS]
+
+import os, sys, subprocess
+
+BASE    = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+MODULE  = "easyhg.commit"
+HEAVY   = ("urwid", "urwide", "easyhg.commitui", "easyhg.mergetool", "easyhg.diff",
+	"mercurial.commands", "mercurial.cmdutil", "mercurial.localrepo")
+SNIPPET = """\
+import sys, time
+sys.path.insert(0, %r)
+t = time.time()
+import %s
+t = time.time() - t
+print("%%f %%s" %% (t * 1000, " ".join(_ for _ in %r if _ in sys.modules)))
+"""
+
+def measure( runs ):
+	"""Returns the sorted import times (in ms) and the heavy modules that were
+	imported, each import being done in a fresh interpreter."""
+	times, heavy = [], set()
+	for _ in range(runs):
+		out = subprocess.check_output([sys.executable, "-c", SNIPPET % (BASE, MODULE, HEAVY)])
+		out = out.decode("utf8").split()
+		times.append(float(out[0]))
+		heavy.update(out[1:])
+	return sorted(times), heavy
+
+if __name__ == "__main__":
+	runs   = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+	max_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 50.0
+	times, heavy = measure(runs)
+	median = times[len(times) // 2]
+	print("import %s: median %.1fms, min %.1fms, max %.1fms (%d runs)" % (
+		MODULE, median, times[0], times[-1], runs))
+	status = 0
+	if heavy:
+		print("FAIL: %s imported %s" % (MODULE, ", ".join(sorted(heavy))))
+		status = 1
+	if median > max_ms:
+		print("FAIL: median import time above %.1fms" % (max_ms))
+		status = 1
+	sys.exit(status)
+
+# EOF - vim: tw=80 ts=4 sw=4 noet